@@ -0,0 +1,495 @@
+import os
+import sys
+import glob
+import json
+import time
+import resource
+import subprocess
+import tracemalloc
+import argparse
+import numpy as np
+import cv2
+
+import UtilImage
+import UtilLines
+import UtilMask
+from UtilStats import stats
+
+def syntheticMask(height=720, width=1280, density=0.2, seed=0):
+    """Top-down binary mask with two lane curves buried in random noise.  'density' is
+        the fraction of noise pixels that are lit.
+    """
+    rng = np.random.RandomState(seed)
+    binary = np.zeros((height, width), np.uint8)
+    binary[rng.random_sample((height, width)) < density] = 255
+
+    ploty = np.arange(height)
+    for base in (300, 1000):
+        fitx = np.int32(base + 80*np.sin(ploty/height*np.pi))
+        for dx in range(-10, 10):
+            binary[ploty, np.clip(fitx+dx, 0, width-1)] = 255
+    return binary
+
+def blindSearchReference(binary_warped, nwindows=9, margin=100, minpix=50):
+    """Original lecture-notes sliding window search, kept to check PixelBands against.
+        Returns nonzerox, nonzeroy, lft_lane_inds, rgt_lane_inds.
+    """
+    height = binary_warped.shape[0]
+    histogram = np.sum(binary_warped[height//2:,:] != 0, axis=0)
+    midpoint = int(histogram.shape[0]/2)
+    lftx_current = np.argmax(histogram[:midpoint])
+    rgtx_current = np.argmax(histogram[midpoint:]) + midpoint
+
+    window_height = int(height/nwindows)
+    nonzero = binary_warped.nonzero()
+    nonzeroy = np.array(nonzero[0])
+    nonzerox = np.array(nonzero[1])
+    lft_lane_inds = []
+    rgt_lane_inds = []
+    for window in range(nwindows):
+        win_y_lo = height - (window+1)*window_height
+        win_y_hi = height - window*window_height
+        good_lft_inds = ((nonzeroy >= win_y_lo) & (nonzeroy < win_y_hi) & (nonzerox >= lftx_current - margin) & (nonzerox < lftx_current + margin)).nonzero()[0]
+        good_rgt_inds = ((nonzeroy >= win_y_lo) & (nonzeroy < win_y_hi) & (nonzerox >= rgtx_current - margin) & (nonzerox < rgtx_current + margin)).nonzero()[0]
+        lft_lane_inds.append(good_lft_inds)
+        rgt_lane_inds.append(good_rgt_inds)
+        if len(good_lft_inds) > minpix:
+            lftx_current = int(np.mean(nonzerox[good_lft_inds]))
+        if len(good_rgt_inds) > minpix:
+            rgtx_current = int(np.mean(nonzerox[good_rgt_inds]))
+
+    return nonzerox, nonzeroy, np.concatenate(lft_lane_inds), np.concatenate(rgt_lane_inds)
+
+def timeIt(func, repeat):
+    """Best wall time of 'repeat' calls, in milliseconds"""
+    best = float('inf')
+    for i in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best*1000
+
+def benchSearch(densities=(0.01, 0.05, 0.2, 0.4), repeat=5):
+    """Micro-benchmark of LaneLines.blindSearch against the reference search on synthetic
+        dense masks.  Also checks that both return exactly the same lane indices.
+    """
+    allSame = True
+    for density in densities:
+        binary  = syntheticMask(density=density)
+        out_img = np.zeros(binary.shape+(3,), np.uint8)
+        lanes   = UtilLines.LaneLines()
+        lanes.imgShape = binary.shape
+
+        ref = blindSearchReference(binary)
+        lanes.blindSearch(binary, out_img)
+        same = np.array_equal(ref[2], lanes.lft_lane_inds) and np.array_equal(ref[3], lanes.rgt_lane_inds)
+        allSame = allSame and same
+
+        refMs  = timeIt(lambda: blindSearchReference(binary), repeat)
+        bandMs = timeIt(lambda: lanes.blindSearch(binary, out_img), repeat)
+        print("density {:4.2f}  lit {:7d}  reference {:7.2f} ms  banded {:7.2f} ms  x{:4.1f}  same={}".format(
+            density, ref[0].size, refMs, bandMs, refMs/bandMs, same))
+    return allSame
+
+# fits are compared by their x at every image row, in pixels
+FIT_TOLERANCE_PX = 1e-6
+
+def checkFit(trials=200, height=720, seed=0):
+    """MomentFit against np.polyfit on noisy synthetic lane pixels, plus the analytic world
+        space coefficients against a polyfit through the meters-scaled curve.
+    """
+    rng = np.random.RandomState(seed)
+    fitter = UtilLines.MomentFit(height)
+    worst = 0.0
+    worstWorld = 0.0
+    for trial in range(trials):
+        count = rng.randint(150, 20000)
+        ys = rng.randint(0, height, count)
+        truth = [rng.uniform(-5e-4, 5e-4), rng.uniform(-0.5, 0.5), rng.uniform(100, 1200)]
+        xs = np.int64(np.polyval(truth, ys) + rng.normal(0, 15, count))
+        
+        ref  = np.polyfit(ys, xs, 2)
+        fast = fitter.fit(xs, ys)
+        worst = max(worst, np.abs(fitter.evaluate(ref) - fitter.evaluate(fast)).max())
+        
+        refWorld = np.polyfit(fitter.ploty*UtilLines.ym_per_pix, fitter.evaluate(ref)*UtilLines.xm_per_pix, 2)
+        worstWorld = max(worstWorld, np.abs(refWorld - UtilLines.worldFit(ref)).max())
+    
+    print("fit: worst row difference {:.2e} px (tolerance {:.0e}), world coefficient difference {:.2e}".format(
+        worst, FIT_TOLERANCE_PX, worstWorld))
+    return worst <= FIT_TOLERANCE_PX and worstWorld <= 1e-9
+
+# coarse-to-fine lines may differ from the full resolution search by this much, in pixels
+# at any row (a lane line is about 20 pixels wide in the top-down view)
+COARSE_TOLERANCE_PX = 20.0
+
+def checkCoarse(scales=(0.5, 0.25), dirName='test_images'):
+    """Coarse-to-fine blind search against the full resolution search on the test images"""
+    import main
+    ok = True
+    topDowns = [(os.path.basename(f), main.birdsEye(img).copy()) 
+                for f, img in ((f, UtilImage.imread(f)) for f in sorted(glob.glob(os.path.join(dirName, '*.jpg'))))]
+    for scale in scales:
+        worst = 0.0
+        for fileName, topDown in topDowns:
+            full   = UtilLines.LaneLines(coarseScale=0)
+            coarse = UtilLines.LaneLines(coarseScale=scale)
+            try:
+                full.processFrame(topDown)
+            except Exception:
+                continue # the full resolution pipeline can not handle this image either
+            try:
+                coarse.processFrame(topDown)
+                diff = max(np.abs(full.lft_fitx - coarse.lft_fitx).max(), np.abs(full.rgt_fitx - coarse.rgt_fitx).max())
+            except Exception:
+                diff = float('inf')
+            worst = max(worst, diff)
+            print("  coarse {:4.2f}  {:20s} max row difference {:6.2f} px".format(scale, fileName, diff))
+        print("coarse {:4.2f}: worst {:.2f} px, tolerance {:.0f} px".format(scale, worst, COARSE_TOLERANCE_PX))
+        ok = ok and worst <= COARSE_TOLERANCE_PX
+    return ok
+
+# drawLaneFill() only differs from the warped fill at polygon edges, where the warp
+# interpolates, so at most this fraction of pixels may differ by more than 2 levels
+OVERLAY_TOLERANCE = 0.005
+
+def laneFillReference(lanes, perspective):
+    """The original lane fill: polygon filled in the top-down view and warped back"""
+    warp_zero  = np.zeros(lanes.imgShape).astype(np.uint8)
+    color_warp = np.dstack((warp_zero, warp_zero, warp_zero))
+    pts_lft = np.array([np.transpose(np.vstack([lanes.lft_fitx, lanes.ploty]))])
+    pts_rgt = np.array([np.flipud(np.transpose(np.vstack([lanes.rgt_fitx, lanes.ploty])))])
+    pts = np.hstack((pts_lft, pts_rgt))
+    cv2.fillPoly(color_warp, np.int_([pts]), (0,255, 0))
+    return perspective.topDownInv(color_warp)
+
+def checkOverlay(frames=20):
+    """drawLaneFill() against laneFillReference() blended with weighted_img()"""
+    import main
+    lanes = UtilLines.LaneLines()
+    worst = 0.0
+    for image in syntheticFrames(frames):
+        imgUD, topDown, frameMask = main.prepareFrame(image)
+        lanes.processFrame(topDown, frameMask=frameMask)
+        ref  = UtilMask.weighted_img(laneFillReference(lanes, main.perspective), imgUD, α=0.8, β=0.3)
+        fast = lanes.drawLaneFill(imgUD.copy(), main.perspective, α=0.8, β=0.3)
+        diff = np.abs(ref.astype(np.int16) - fast).max(axis=2)
+        worst = max(worst, np.count_nonzero(diff > 2)/diff.size)
+    print("overlay: worst fraction of pixels off by > 2 levels {:.2e}, tolerance {:.0e}".format(worst, OVERLAY_TOLERANCE))
+    return worst <= OVERLAY_TOLERANCE
+
+# after warm-up, the transient peak of one steady state frame must stay below this many
+# bytes (one 1280x720 RGB frame is 2.7 MB), and the traced total must not keep growing
+ALLOC_BUDGET_BYTES = 2*2**20
+
+def checkAllocations(warmup=10, frames=30):
+    """tracemalloc check that steady state tracking frames barely allocate"""
+    import main
+    images = list(syntheticFrames(warmup + frames))
+    main.laneLines = UtilLines.LaneLines()
+    for image in images[:warmup]:
+        main.imagePipeline(image)
+    
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    worst = 0
+    for image in images[warmup:]:
+        before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        main.imagePipeline(image)
+        worst = max(worst, tracemalloc.get_traced_memory()[1] - before)
+    growth = tracemalloc.get_traced_memory()[0] - start
+    tracemalloc.stop()
+    
+    print("allocations: worst frame peak {:.2f} MB (budget {:.2f} MB), growth over {} frames {:.2f} MB".format(
+        worst/2**20, ALLOC_BUDGET_BYTES/2**20, frames, growth/2**20))
+    return worst <= ALLOC_BUDGET_BYTES and growth <= ALLOC_BUDGET_BYTES
+
+# after warm-up, a segment's fits may differ from the serial run's by this many pixels 
+# anywhere along the lines
+SEGMENT_TOLERANCE_PX = 2.0
+
+def checkSegments(frames=120, segments=3, warmup=20, workers=2):
+    """processMovieSegments() fits against one serial pass over the same synthetic movie"""
+    import main
+    import tempfile
+    import UtilVideo
+    import UtilParallel
+    with tempfile.TemporaryDirectory() as tmpDir:
+        movieName = os.path.join(tmpDir, 'synthetic.mp4')
+        with UtilVideo.FrameWriter(movieName, (1280, 720), 25) as writer:
+            for image in syntheticFrames(frames):
+                writer.write(image)
+        
+        main.laneLines = UtilLines.LaneLines()
+        serial = []
+        for frame in UtilVideo.FrameReader(movieName).frames():
+            main.imagePipeline(frame)
+            serial.append(UtilParallel.laneFits(main.laneLines))
+        serial = np.array(serial)
+        parallel = main.processMovieSegments(movieName, workers, os.path.join(tmpDir, 'out.mp4'), segments, warmup)
+    
+    if len(parallel) != len(serial):
+        print("segments: {} frames, serial run has {}".format(len(parallel), len(serial)))
+        return False
+    ploty = np.linspace(0, 719, 8)
+    worst = 0.0
+    for col in (0, 3):
+        fx = lambda fits: fits[:, col:col+1]*ploty**2 + fits[:, col+1:col+2]*ploty + fits[:, col+2:col+3]
+        worst = max(worst, np.nanmax(np.abs(fx(parallel) - fx(serial))))
+    print("segments: {} segments, {} warm-up frames, worst fit difference {:.3f} px, tolerance {:.1f} px".format(
+        segments, warmup, worst, SEGMENT_TOLERANCE_PX))
+    return worst <= SEGMENT_TOLERANCE_PX
+
+def checkParallelMovie(frames=60, workers=2):
+    """processMovie() with a process pool must write the same frames as the serial run,
+        with and without adaptive scheduling.  The synthetic lanes are steady, so with
+        adaptive scheduling both runs must also coast on some frames.
+    """
+    import main
+    import tempfile
+    import UtilVideo
+    ok = True
+    adaptive = UtilLines.LaneLines.adaptive
+    with tempfile.TemporaryDirectory() as tmpDir:
+        movieName = os.path.join(tmpDir, 'synthetic.mp4')
+        with UtilVideo.FrameWriter(movieName, (1280, 720), 25) as writer:
+            for image in syntheticFrames(frames):
+                writer.write(image)
+        try:
+            for mode in (False, True):
+                UtilLines.LaneLines.adaptive = mode
+                outputs = []
+                counters = []
+                for runWorkers in (0, workers):
+                    main.laneLines = UtilLines.LaneLines()
+                    outName = os.path.join(tmpDir, 'out-{}.mp4'.format(runWorkers))
+                    stats.enable()
+                    try:
+                        main.processMovie(movieName, runWorkers, outName)
+                        counters.append(stats.summary()['counters'])
+                    finally:
+                        stats.disable()
+                    outputs.append([frame.copy() for frame in UtilVideo.FrameReader(outName).frames()])
+                serial, parallel = outputs
+                worst = max([np.abs(a.astype(np.int16) - b).max() for a, b in zip(serial, parallel)] or [0])
+                same = len(serial) == len(parallel) == frames and worst == 0
+                coasted = [c.get('coasted', 0) for c in counters]
+                print("parallel movie: adaptive={} {} workers, {} of {} frames, worst difference {} levels, "
+                      "coasted {} serial {} parallel, {} missed".format(mode, workers, len(parallel), len(serial), 
+                      worst, coasted[0], coasted[1], counters[1].get('coastMissed', 0)))
+                ok = ok and same and (not mode or min(coasted) > 0)
+        finally:
+            UtilLines.LaneLines.adaptive = adaptive
+    return ok
+
+def runChecks():
+    """Equivalence checks of the fast paths against the original implementations"""
+    ok = benchSearch(repeat=1)
+    ok = checkFit() and ok
+    ok = checkCoarse() and ok
+    ok = checkOverlay() and ok
+    ok = checkAllocations() and ok
+    ok = checkSegments() and ok
+    ok = checkParallelMovie() and ok
+    return ok
+
+def syntheticFrames(count, width=1280, height=720, noise=12.0, seed=0):
+    """Camera-view frames with a yellow left line and a dashed white right line drawn on 
+        grey asphalt in the birds-eye view, warped back to the camera view, plus noise.
+        The road curvature drifts slowly so tracking has something to follow.
+    """
+    rng = np.random.RandomState(seed)
+    perspective = UtilMask.Perspective()
+    perspective.calcTransform(np.zeros((height, width, 3), np.uint8))
+    ploty = np.arange(0, height, 4)
+    
+    for frame in range(count):
+        bend = 120*np.sin(frame/60.0)
+        topDown = np.full((height, width, 3), 90, np.uint8)
+        for base, color, dashed in ((238, (230, 200, 40), False), (1038, (235, 235, 235), True)):
+            fitx = base + bend*(1 - ploty/height)**2
+            pts = np.int32(np.stack([fitx, ploty], axis=1))
+            for i in range(len(pts)-1):
+                if dashed and ((ploty[i] + 8*frame) // 80) % 2:
+                    continue
+                cv2.line(topDown, tuple(pts[i]), tuple(pts[i+1]), color, 24)
+        
+        image = perspective.topDownInv(topDown)
+        # the sky and hood are outside the warp, give them some texture too
+        image[image.sum(axis=2) == 0] = (120, 140, 170)
+        image = np.clip(image + rng.normal(0, noise, image.shape), 0, 255).astype(np.uint8)
+        yield image
+
+
+def runFrames(main, frames, fresh, memFrames=5):
+    """Time main.imagePipeline over 'frames'.  If 'fresh' every frame gets new LaneLines 
+        (like processImages), otherwise tracking state carries over (like a movie).
+        Stage latencies come from the pipeline's own UtilStats timers.  The first 
+        'memFrames' are run again afterwards under tracemalloc for peak memory.
+    """
+    main.laneLines = UtilLines.LaneLines()
+    kept  = []
+    total = 0.0
+    count = 0
+    stats.enable(samples=True)
+    try:
+        for image in frames:
+            if fresh:
+                main.laneLines = UtilLines.LaneLines()
+            start = time.perf_counter()
+            main.imagePipeline(image)
+            total += time.perf_counter() - start
+            count += 1
+            if len(kept) < memFrames:
+                kept.append(image)
+        stages = stats.latency()
+    finally:
+        stats.disable()
+    
+    # separate pass so tracemalloc overhead does not pollute the timings
+    main.laneLines = UtilLines.LaneLines()
+    tracemalloc.start()
+    for image in kept:
+        main.imagePipeline(image)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    
+    return {'frames': count, 'fps': count/total if total > 0 else 0.0, 
+            'peak_traced_mb': peak/2**20, 'stages': stages}
+
+def imageFrames(dirName):
+    for fileName in sorted(glob.glob(os.path.join(dirName, '*.jpg'))):
+        yield UtilImage.imread(fileName)
+
+def videoFrames(movieName, maxFrames):
+    import UtilVideo
+    reader = UtilVideo.FrameReader(movieName)
+    for idx, frame in enumerate(reader.frames()):
+        if idx >= maxFrames:
+            break
+        yield frame.copy()
+
+# short jobs timed in fresh interpreters by benchStartup(), {image} is a test still
+STARTUP_JOBS = {'import_main':  "import main",
+                'single_frame': "import main, UtilImage; main.imagePipeline(UtilImage.imread({image!r}))"}
+# top level packages that short jobs should not pay for
+HEAVY_MODULES = ('matplotlib', 'moviepy', 'multiprocessing', 'UtilVideo', 'UtilParallel', 'UtilTelemetry')
+
+def benchStartup(runs=5, image='test_images/test1.jpg'):
+    """Cold start wall time of each STARTUP_JOBS entry in a new interpreter, and which 
+        HEAVY_MODULES it imported.  One untimed run first fills the calibration caches.
+    """
+    report = "\nimport sys, json; print(json.dumps(sorted(m for m in sys.modules if m.split('.')[0] in %r)))" %(HEAVY_MODULES,)
+    here = os.path.dirname(os.path.abspath(__file__))
+    results = {}
+    for name, code in STARTUP_JOBS.items():
+        if image is None and '{image' in code:
+            continue
+        script = code.format(image=os.path.abspath(image)) + report
+        times = []
+        for run in range(runs + 1):
+            start = time.perf_counter()
+            proc = subprocess.run([sys.executable, '-c', script], cwd=here, stdout=subprocess.PIPE, 
+                                  stderr=subprocess.PIPE, universal_newlines=True)
+            elapsed = time.perf_counter() - start
+            if proc.returncode != 0:
+                raise Exception("Error, startup job %s failed:\n%s" %(name, proc.stderr))
+            if run > 0:
+                times.append(elapsed)
+        results[name] = {'runs': runs, 'min_s': min(times), 'median_s': float(np.median(times)),
+                         'heavy_modules': json.loads(proc.stdout.strip().splitlines()[-1])}
+    return results
+
+def compare(results, baseline, threshold):
+    """List of regressions: stage mean latency up, or fps down, by more than 'threshold'"""
+    regressions = []
+    for inputName, base in baseline.get('inputs', {}).items():
+        new = results['inputs'].get(inputName)
+        if new is None:
+            continue
+        if new['fps'] < base['fps']*(1 - threshold):
+            regressions.append("{}: fps {:.2f} -> {:.2f}".format(inputName, base['fps'], new['fps']))
+        for stage, baseStage in base['stages'].items():
+            newStage = new['stages'].get(stage)
+            if newStage and newStage['mean_ms'] > baseStage['mean_ms']*(1 + threshold):
+                regressions.append("{}/{}: mean {:.2f} ms -> {:.2f} ms".format(
+                    inputName, stage, baseStage['mean_ms'], newStage['mean_ms']))
+    for name, base in baseline.get('startup', {}).items():
+        new = results.get('startup', {}).get(name)
+        if new is None:
+            continue
+        if new['median_s'] > base['median_s']*(1 + threshold):
+            regressions.append("startup/{}: median {:.3f} s -> {:.3f} s".format(name, base['median_s'], new['median_s']))
+        added = sorted(set(new['heavy_modules']) - set(base['heavy_modules']))
+        if added:
+            regressions.append("startup/{}: now imports {}".format(name, ', '.join(added)))
+    return regressions
+
+def printResults(results):
+    for name, s in results.get('startup', {}).items():
+        print("startup {}: median {:.3f} s, min {:.3f} s over {} runs, heavy modules: {}".format(
+            name, s['median_s'], s['min_s'], s['runs'], ', '.join(s['heavy_modules']) or 'none'))
+    for inputName, result in results['inputs'].items():
+        print("{}: {} frames, {:.2f} fps, peak traced {:.1f} MB".format(
+            inputName, result['frames'], result['fps'], result['peak_traced_mb']))
+        for stage, s in sorted(result['stages'].items()):
+            print("    {:14s} n={:5d}  mean {:7.2f}  p50 {:7.2f}  p99 {:7.2f} ms".format(
+                stage, s['count'], s['mean_ms'], s['p50_ms'], s['p99_ms']))
+    if 'max_rss_mb' in results:
+        print("max RSS {:.1f} MB".format(results['max_rss_mb']))
+
+def startupImage(dirName):
+    stills = sorted(glob.glob(os.path.join(dirName or 'test_images', '*.jpg')))
+    return stills[0] if stills else None
+
+def runBenchmarks(args):
+    results = {'inputs': {}}
+    # time the cold starts before this process imports main and its modules
+    image = startupImage(args.images)
+    if args.startup_runs > 0 and image:
+        results['startup'] = benchStartup(args.startup_runs, image)
+    import main
+    if args.images:
+        results['inputs']['images'] = runFrames(main, imageFrames(args.images), fresh=True)
+    if args.video:
+        results['inputs']['video'] = runFrames(main, videoFrames(args.video, args.frames), fresh=False)
+    else:
+        results['inputs']['synthetic'] = runFrames(main, syntheticFrames(args.frames), fresh=False)
+    # ru_maxrss is in kB on Linux
+    results['max_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Per-stage pipeline benchmarks')
+    parser.add_argument('--images', default='test_images', help='folder of .jpg stills, empty to skip')
+    parser.add_argument('--video', help='movie to time, default is synthetic frames')
+    parser.add_argument('--frames', type=int, default=200, help='number of movie or synthetic frames')
+    parser.add_argument('--out', default='bench_results.json', help='JSON results file')
+    parser.add_argument('--baseline', help='JSON results to compare against')
+    parser.add_argument('--threshold', type=float, default=0.2, help='allowed slowdown vs the baseline')
+    parser.add_argument('--search', action='store_true', help='only run the blindSearch micro-benchmark')
+    parser.add_argument('--startup-runs', type=int, default=5, help='cold start runs per startup job, 0 to skip')
+    parser.add_argument('--startup', action='store_true', help='only run the cold start benchmark')
+    parser.add_argument('--check', action='store_true', help='only run the equivalence checks')
+    args = parser.parse_args()
+    
+    if args.search:
+        sys.exit(0 if benchSearch() else 1)
+    if args.check:
+        sys.exit(0 if runChecks() else 1)
+    
+    if args.startup:
+        results = {'inputs': {}, 'startup': benchStartup(max(args.startup_runs, 1), startupImage(args.images))}
+    else:
+        results = runBenchmarks(args)
+    printResults(results)
+    with open(args.out, 'w') as f:
+        json.dump(results, f, indent=2)
+    
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for regression in regressions:
+            print("REGRESSION", regression)
+        sys.exit(1 if regressions else 0)
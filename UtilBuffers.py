@@ -0,0 +1,20 @@
+import numpy as np
+
+class BufferPool:
+    """Reusable output arrays keyed by name, handed to OpenCV (dst=) and NumPy (out=) so a
+        steady stream of same-sized frames stops allocating.  An array returned by get()
+        is overwritten the next time the same name is asked for, so copy anything that 
+        must outlive the frame.
+    """
+    def __init__(self):
+        self.buffers = {}
+    
+    def get(self, name, shape, dtype=np.uint8):
+        buf = self.buffers.get(name)
+        if buf is None or buf.shape != tuple(shape) or buf.dtype != dtype:
+            buf = np.empty(shape, dtype)
+            self.buffers[name] = buf
+        return buf
+    
+    def nbytes(self):
+        return sum(buf.nbytes for buf in self.buffers.values())
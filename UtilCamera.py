@@ -3,66 +3,182 @@ import cv2
 import glob
 import os.path
 import pickle
-import matplotlib.pyplot as plt
+import tempfile
+import threading
 
-CALIBRATION_FILE = 'camera_calibration.p'
+CALIBRATION_FILE    = 'camera_calibration.p'
+CALIBRATION_VERSION = 2
+REMAP_FILE          = 'camera_remap.p'
+CORNER_CACHE_NAME   = 'corners_cache.p'  # kept next to the calibration images
+BOARD_SIZE          = (9, 6)
 
 class Camera:
     """Class to calibrate camera, and undistort images"""
     
     def __init__(self):
+        """Nothing is loaded until the first frame needs it, see loadCalibration()"""
+        # remap tables keyed by image size (width, height), see loadMaps()
+        self.undistMaps = {}
+        self.warpMaps   = {}
+        self.mapsLoaded = False
+        self.calibrated = False
+        # one camera may be shared by threads, only one of them builds a missing table
+        self.mapsLock   = threading.Lock()
+    
+    def loadCalibration(self):
         """If the calibration file is present, load calibration.  Otherwise use 
             camera calibration images from camera_cal/ to compute calibration.
         """
+        if self.calibrated:
+            return
         if os.path.isfile(CALIBRATION_FILE):
-            # load calibration
+            # load calibration, version 1 files only had 'mtx' and 'dist'
             cam_pickle = pickle.load(open(CALIBRATION_FILE, "rb"))
             self.cameraMatrix = cam_pickle['mtx']
             self.distCoeffs   = cam_pickle['dist']
+            self.imgSize      = cam_pickle.get('img_size')
+            self.calibrated   = True
         else:
             self.calibrateCamera()
     
-    def calibrateCamera(self):
+    def calibrateCamera(self, pattern='camera_cal/cal*.jpg', workers=None, drawDir=None):
+        """Calibrate from chessboard images.  Corners are found in parallel and cached per 
+            image, so adding images to the set only processes the new ones.  If 'drawDir'
+            is given, each board is written there with its corners drawn.
+        """
         # index array
-        objp = np.zeros((6*9,3), np.float32)
-        objp[:,:2] = np.mgrid[0:9, 0:6].T.reshape(-1,2)
+        objp = np.zeros((BOARD_SIZE[1]*BOARD_SIZE[0],3), np.float32)
+        objp[:,:2] = np.mgrid[0:BOARD_SIZE[0], 0:BOARD_SIZE[1]].T.reshape(-1,2)
         
-        objpoints = [] # 3d points in real world space
-        imgpoints = [] # 2d points in image plane.
+        detections = findAllCorners(sorted(glob.glob(pattern)), workers)
         
-        # Make a list of calibration images
-        images = glob.glob('camera_cal/cal*.jpg')
+        # all images must be the same size, use the most common one
+        sizes = [size for size, corners in detections.values() if corners is not None]
+        if not sizes:
+            raise Exception("Error, no chessboards found in %s" %pattern)
+        img_size = max(set(sizes), key=sizes.count)
         
-        # Step through the list and search for chessboard corners
-        for idx, fname in enumerate(images):
-            img = cv2.imread(fname)
-            gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-
-            # Find the chessboard corners
-            ret, corners = cv2.findChessboardCorners(gray, (9,6), None)
-
-            # If found, add object points, image points
-            if ret == True:
-                objpoints.append(objp)
-                imgpoints.append(corners)
-
+        objpoints = [] # 3d points in real world space
+        imgpoints = [] # 2d points in image plane.
+        for fname, (size, corners) in sorted(detections.items()):
+            if corners is None:
+                continue
+            if size != img_size:
+                print("Skipping %s, size %s does not match %s" %(fname, size, img_size))
+                continue
+            objpoints.append(objp)
+            imgpoints.append(corners)
+            
+            if drawDir:
                 # Draw and display the corners
-                cv2.drawChessboardCorners(img, (9,6), corners, ret)
-                write_name = 'tmp/corners_found'+str(idx)+'.jpg'
-                cv2.imwrite(write_name, img)
-    
+                os.makedirs(drawDir, exist_ok=True)
+                img = cv2.imread(fname)
+                cv2.drawChessboardCorners(img, BOARD_SIZE, corners, True)
+                cv2.imwrite(os.path.join(drawDir, 'corners_'+os.path.basename(fname)), img)
+        
         # Do camera calibration given object points and image points
-        img_size = (img.shape[1], img.shape[0])
         ret, mtx, dist, rvecs, tvecs = cv2.calibrateCamera(objpoints, imgpoints, img_size,None,None)
         self.cameraMatrix = mtx
         self.distCoeffs   = dist
+        self.imgSize      = img_size
+        self.calibrated   = True
+        # remap tables belong to the old calibration
+        self.undistMaps = {}
+        self.warpMaps   = {}
+        self.mapsLoaded = True
         
         # Save the camera calibration result for later use (we won't worry about rvecs / tvecs)
-        cam_pickle = {'mtx':mtx, 'dist':dist}
-        pickle.dump( cam_pickle, open(CALIBRATION_FILE, "wb") )
+        cam_pickle = {'version':CALIBRATION_VERSION, 'mtx':mtx, 'dist':dist, 'img_size':img_size, 
+                      'images':len(objpoints), 'rms':ret}
+        dumpCache(cam_pickle, CALIBRATION_FILE)
+    
+    def undistort(self, img, dst=None):
+        """Same result as cv2.undistort(), but the remap table is only built once per image size"""
+        map1, map2 = self.getUndistortMaps((img.shape[1], img.shape[0]))
+        return cv2.remap(img, map1, map2, cv2.INTER_LINEAR, dst=dst)
+    
+    def topDown(self, img, perspective, dst=None):
+        """Un-distort and warp a raw frame to the birds-eye view with a single remap.  This
+            replaces undistort() followed by perspective.topDown().
+        """
+        if not perspective.isSetup:
+            perspective.calcTransform(img)
+        map1, map2 = self.getWarpMaps(perspective.warpMat, perspective.shape)
+        return cv2.remap(img, map1, map2, cv2.INTER_LINEAR, dst=dst)
     
-    def undistort(self, img):
-        return cv2.undistort(img, self.cameraMatrix, self.distCoeffs, None, self.cameraMatrix)
+    def getUndistortMaps(self, size):
+        """Fixed-point remap table that un-distorts an image of the given (width, height)"""
+        maps = self.undistMaps.get(size)
+        if maps is not None:
+            return maps
+        with self.mapsLock:
+            self.loadMaps()
+            if size not in self.undistMaps:
+                self.undistMaps[size] = cv2.initUndistortRectifyMap(self.cameraMatrix, self.distCoeffs, None, 
+                                                                    self.cameraMatrix, size, cv2.CV_16SC2)
+                self.saveMaps()
+            return self.undistMaps[size]
+    
+    def getWarpMaps(self, warpMat, size):
+        """Fixed-point remap table that goes straight from a raw (distorted) frame to the
+            top-down image given by the perspective matrix 'warpMat'.
+        """
+        cached = self.warpMaps.get(size)
+        if cached is not None and np.array_equal(cached[0], warpMat):
+            return cached[1:]
+        with self.mapsLock:
+            self.loadMaps()
+            cached = self.warpMaps.get(size)
+            if cached is None or not np.array_equal(cached[0], warpMat):
+                map1, map2 = self.calcWarpMaps(warpMat, size)
+                cached = (np.array(warpMat), map1, map2)
+                self.warpMaps[size] = cached
+                self.saveMaps()
+            return cached[1:]
+    
+    def calcWarpMaps(self, warpMat, size):
+        """For every pixel of the top-down image, find its location in the un-distorted 
+            image (inverse perspective), then push that point through the lens distortion 
+            model to find where it lives in the raw frame.
+        """
+        width, height = size
+        xs, ys = np.meshgrid(np.arange(width, dtype=np.float64), np.arange(height, dtype=np.float64))
+        topPts = np.stack([xs.ravel(), ys.ravel()], axis=1).reshape(-1, 1, 2)
+        undistPts = cv2.perspectiveTransform(topPts, np.linalg.inv(warpMat)).reshape(-1, 2)
+        
+        # un-distorted pixels -> normalized camera coordinates (undistort() uses the same 
+        # camera matrix for the new view, so this is the exact inverse of its projection)
+        fx, fy = self.cameraMatrix[0, 0], self.cameraMatrix[1, 1]
+        cx, cy = self.cameraMatrix[0, 2], self.cameraMatrix[1, 2]
+        objPts = np.ones((undistPts.shape[0], 3), np.float64)
+        objPts[:, 0] = (undistPts[:, 0] - cx) / fx
+        objPts[:, 1] = (undistPts[:, 1] - cy) / fy
+        
+        # apply the distortion model to land in raw frame pixels
+        zero = np.zeros(3, np.float64)
+        rawPts, _ = cv2.projectPoints(objPts, zero, zero, self.cameraMatrix, self.distCoeffs)
+        mapx = rawPts[:, 0, 0].reshape(height, width).astype(np.float32)
+        mapy = rawPts[:, 0, 1].reshape(height, width).astype(np.float32)
+        
+        return cv2.convertMaps(mapx, mapy, cv2.CV_16SC2)
+    
+    def loadMaps(self):
+        """Load the calibration and any remap tables saved by a previous run"""
+        if self.mapsLoaded:
+            return
+        self.loadCalibration()
+        self.mapsLoaded = True
+        maps_pickle = loadCache(REMAP_FILE)
+        if maps_pickle is None:
+            return
+        # tables are only valid for the calibration they were built from
+        if np.array_equal(maps_pickle['mtx'], self.cameraMatrix) and np.array_equal(maps_pickle['dist'], self.distCoeffs):
+            self.undistMaps = maps_pickle['undist']
+            self.warpMaps   = maps_pickle['warp']
+    
+    def saveMaps(self):
+        maps_pickle = {'mtx':self.cameraMatrix, 'dist':self.distCoeffs, 'undist':self.undistMaps, 'warp':self.warpMaps}
+        dumpCache(maps_pickle, REMAP_FILE)
     
     def writeTest(self):
         images = glob.glob('camera_cal/calibration1.jpg')
@@ -70,6 +186,97 @@ class Camera:
         dst = self.undistort(img)
         cv2.imwrite('output_images/calibration1_undist.jpg', dst)
 
+def dumpCache(obj, fileName):
+    """Pickle to a temp file next to 'fileName' and rename it into place, so processes 
+        reading the cache at the same time never see a half written file
+    """
+    fd, tmpName = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(fileName)), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(obj, f)
+        os.replace(tmpName, fileName)
+    except:
+        os.remove(tmpName)
+        raise
+
+def loadCache(fileName):
+    """Unpickled cache file, or None if it is missing or unreadable (it is then rebuilt)"""
+    if not os.path.isfile(fileName):
+        return None
+    try:
+        with open(fileName, 'rb') as f:
+            return pickle.load(f)
+    except (EOFError, pickle.UnpicklingError, AttributeError, ImportError, ValueError) as e:
+        print("Ignoring unreadable cache %s: %r" %(fileName, e))
+        return None
+
+def findCorners(fname, maxWidth=640):
+    """Chessboard corners of one image.  Boards are detected on a copy downscaled to at most
+        'maxWidth' pixels wide, then refined with a sub-pixel search at full resolution.
+        Returns the image size and the corners (None if no board was found).
+    """
+    gray = cv2.cvtColor(cv2.imread(fname), cv2.COLOR_BGR2GRAY)
+    size = (gray.shape[1], gray.shape[0])
+    
+    scale = min(1.0, maxWidth/gray.shape[1])
+    small = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA) if scale < 1.0 else gray
+    ret, corners = cv2.findChessboardCorners(small, BOARD_SIZE, None)
+    if not ret and scale < 1.0:
+        # small boards can get lost when downscaled, try again at full size
+        scale = 1.0
+        ret, corners = cv2.findChessboardCorners(gray, BOARD_SIZE, None)
+    if not ret:
+        return size, None
+    
+    # pixel centers: x_full = (x_small + 0.5)/scale - 0.5
+    corners = ((corners + 0.5)/scale - 0.5).astype(np.float32)
+    criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.01)
+    cv2.cornerSubPix(gray, corners, (11, 11), (-1, -1), criteria)
+    return size, corners
+
+def _findCornersTask(fname):
+    return fname, findCorners(fname)
+
+def findAllCorners(fileNames, workers=None, cacheFile=None):
+    """Corners for each file as {fname: (size, corners)}.  Results are cached by file name,
+        size and modification time in 'cacheFile' (default CORNER_CACHE_NAME in the folder
+        of the images), and only new or changed images are searched, on a process pool.
+    """
+    if not fileNames:
+        return {}
+    if cacheFile is None:
+        cacheFile = os.path.join(os.path.dirname(fileNames[0]), CORNER_CACHE_NAME)
+    cache = loadCache(cacheFile) or {}
+    
+    def stamp(fname):
+        st = os.stat(fname)
+        return (st.st_size, st.st_mtime_ns)
+    
+    todo = [fname for fname in fileNames if fname not in cache or cache[fname][0] != stamp(fname)]
+    if todo:
+        print("Searching %d of %d calibration images for corners" %(len(todo), len(fileNames)))
+        if workers == 0 or len(todo) == 1:
+            results = list(map(_findCornersTask, todo))
+        else:
+            import multiprocessing
+            with multiprocessing.Pool(workers) as pool:
+                results = list(pool.imap_unordered(_findCornersTask, todo))
+        for fname, detection in results:
+            cache[fname] = (stamp(fname), detection)
+        dumpCache(cache, cacheFile)
+    
+    return {fname: cache[fname][1] for fname in fileNames}
+
 if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Camera calibration')
+    parser.add_argument('--recalibrate', action='store_true', help='calibrate even if a calibration file exists')
+    parser.add_argument('--images', default='camera_cal/cal*.jpg', help='glob pattern of chessboard images')
+    parser.add_argument('--workers', type=int, help='process pool size for corner detection, 0 is serial')
+    parser.add_argument('--draw', help='folder to write boards with their corners drawn')
+    args = parser.parse_args()
+    
     cam = Camera()
+    if args.recalibrate:
+        cam.calibrateCamera(args.images, args.workers, args.draw)
     cam.writeTest()
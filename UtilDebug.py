@@ -0,0 +1,91 @@
+import os
+import queue
+import zipfile
+import threading
+import numpy as np
+import cv2
+
+class DebugWriter:
+    """Write debug stage images from a background thread, so the pipeline never waits on
+        the disk or on image encoding.  save() takes ownership of the image: the caller 
+        must not modify it afterwards (pass a copy if it will be drawn on later).
+        
+        format 'jpg'   : one JPEG per stage, named <frame><stage>
+        format 'frame' : one compressed .npz archive per frame, one array per stage
+        format 'run'   : one compressed .npz archive for the run, arrays named <frame>/<stage>
+    """
+    def __init__(self, outDir="test_images/outputs/", format='jpg', maxQueue=32):
+        self.outDir  = outDir
+        self.format  = format
+        self.queue   = queue.Queue(maxQueue)
+        self.thread  = None
+        self.runZip  = None
+        self.frames  = {}
+    
+    def save(self, frameName, stage, image):
+        """Queue one stage image, blocks only if 'maxQueue' images are already waiting"""
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+        self.queue.put((frameName, stage, image))
+    
+    def endFrame(self, frameName):
+        """In 'frame' format, write out the archive of stages saved for 'frameName'"""
+        if self.format == 'frame' and self.thread is not None:
+            self.queue.put((frameName, None, None))
+    
+    def run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    break
+                self.write(*item)
+            except Exception as e:
+                print("Error, could not write debug output for %s: %r" %(item[0], e))
+            finally:
+                self.queue.task_done()
+    
+    def write(self, frameName, stage, image):
+        if self.format == 'jpg':
+            if image.ndim == 3:
+                image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+            cv2.imwrite(os.path.join(self.outDir, frameName+stage), image)
+        elif self.format == 'frame':
+            if stage is not None:
+                self.frames.setdefault(frameName, {})[stageKey(stage)] = image
+            else:
+                np.savez_compressed(os.path.join(self.outDir, frameName+'.npz'), **self.frames.pop(frameName, {}))
+        else:
+            if self.runZip is None:
+                self.runZip = zipfile.ZipFile(os.path.join(self.outDir, 'debug_run.npz'), 'w', 
+                                              compression=zipfile.ZIP_DEFLATED, allowZip64=True)
+            with self.runZip.open(frameName+'/'+stageKey(stage)+'.npy', 'w', force_zip64=True) as f:
+                np.lib.format.write_array(f, np.asanyarray(image), allow_pickle=False)
+    
+    def flush(self):
+        """Wait until everything queued so far is on disk"""
+        if self.thread is None:
+            return
+        self.queue.join()
+        if self.runZip is not None:
+            self.runZip.fp.flush()
+    
+    def close(self):
+        if self.thread is None:
+            return
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
+        self.thread = None
+        if self.runZip is not None:
+            self.runZip.close()
+            self.runZip = None
+
+def stageKey(stage):
+    """'-2a-topdwn2.jpg' -> '2a-topdwn2', '' (the raw frame) -> 'raw'"""
+    key = os.path.splitext(stage)[0].lstrip('-')
+    return key or 'raw'
+
+# the one writer used by the pipeline
+debug = DebugWriter()
@@ -0,0 +1,21 @@
+import numpy as np
+import cv2
+
+def imread(fileName):
+    """Read an image as 8-bit RGB, like mpimg.imread() does for JPEGs but without 
+        importing matplotlib.  PNGs are also 8-bit here, not float.
+    """
+    image = cv2.imread(fileName, cv2.IMREAD_COLOR)
+    if image is None:
+        raise Exception("Error, could not read image %s" %fileName)
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+def imsave(fileName, image):
+    """Write an 8-bit RGB (or single channel) image, the format comes from the extension"""
+    if image.dtype != np.uint8:
+        # float images are in the 0-1 range, as with mpimg.imsave()
+        image = np.clip(image*255 + 0.5, 0, 255).astype(np.uint8)
+    if image.ndim == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+    if not cv2.imwrite(fileName, image):
+        raise Exception("Error, could not write image %s" %fileName)
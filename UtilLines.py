@@ -1,9 +1,9 @@
-import os
 import numpy as np
 import cv2
-import matplotlib.pyplot as plt
-import matplotlib.image as mpimg
 import UtilMask
+import UtilBuffers
+from UtilStats import stats
+from UtilDebug import debug
 
 ym_per_pix = 15/720 # meters per pixel in y dimension
 xm_per_pix = 3.7/700 # meters per pixel in x dimension
@@ -11,63 +11,153 @@ xm_per_pix = 3.7/700 # meters per pixel in x dimension
 
 class LaneLines:
     """Class to compute lane lines on frames of film."""
-    def __init__(self):
+    # if set, blind searches run on a top-down mask downscaled by this factor, are refined 
+    # at full resolution within 'refineMargin' pixels of the coarse lines, and then tracked
+    # once with the normal margin from the refined fit
+    coarseScale  = None
+    refineMargin = 30
+    # if set, fits are smoothed over a short history and the confidence of each frame 
+    # decides how much work the next one gets, see needsDetection()
+    adaptive       = False
+    historySize    = 8
+    highConfidence = 0.7
+    lowConfidence  = 0.3
+    stableFrames   = 4
+    # color thresholds of the lane binary, and the lower l_thresh used when too few lane 
+    # pixels are found
+    hThresh      = (15, 30)
+    lThresh      = 210
+    lThreshRetry = 180
+    
+    def __init__(self, coarseScale=None, adaptive=None, hThresh=None, lThresh=None):
+        if coarseScale is not None:
+            self.coarseScale = coarseScale
+        if adaptive is not None:
+            self.adaptive = adaptive
+        if hThresh is not None:
+            self.hThresh = hThresh
+        if lThresh is not None:
+            self.lThresh = lThresh
+        self.history    = FitHistory(self.historySize)
+        self.pool       = UtilBuffers.BufferPool()
+        self.confidence = 0.0
+        self.coasted    = False
         self.fontFace  = cv2.FONT_HERSHEY_SIMPLEX
         self.fontColor = (255, 255, 255)
         self.detected = False
+        self.fitters  = {}
     
-    def processFrame(self, topDown, fileName = None):
-        """This is the main line finding pipeline function"""
-        # mask image
-        imgTopMasked = UtilMask.maskPipeline(topDown)
+    def processFrame(self, topDown, fileName = None, frameMask = None, draw = True):
+        """This is the main line finding pipeline function.  With draw=False nothing is 
+            drawn and None is returned, only the lane fits and measurements are updated.
+        """
+        # mask image, planes are only computed when a threshold result asks for them
+        if frameMask is None:
+            frameMask = UtilMask.FrameMask(topDown)
         if fileName:
-            mpimg.imsave(os.path.join("test_images/outputs/", fileName+"-3-mask.jpg"), imgTopMasked)
-        # compute binary image
-        binaryTopDown = UtilMask.binaryImg(imgTopMasked)
+            with stats.stage('maskPipeline'):
+                imgMasked = frameMask.mask()
+            debug.save(fileName, "-3-mask.jpg", imgMasked)
+        self.imgShape = topDown.shape[:2]
+        self.coasted  = False
+        if self.adaptive and self.detected and self.confidence < self.lowConfidence:
+            # tracking is shaky, go back to a full search
+            self.detected = False
+            stats.count('lowConfidence')
+        
+        if self.detected:
+            # tracking only needs the mask inside the band around the previous fits
+            with stats.stage('mask'):
+                binaryTopDown = frameMask.bandBinary(self.trackSpans(), self.hThresh, self.lThresh)
+            with stats.stage('updateLanes'):
+                found = self.updateLanes(binaryTopDown)
+            stats.count('updateOk' if found else 'updateLost')
+        else:
+            found = False
+        
+        if not found and self.coarseScale:
+            with stats.stage('coarseSearch'):
+                binaryTopDown, found = self.coarseSearch(frameMask)
+            stats.count('coarseSearch')
+        
+        if not found:
+            # compute binary image
+            with stats.stage('mask'):
+                binaryTopDown = frameMask.binary(self.hThresh, self.lThresh)
         
         # Create an output image to draw on and  visualize the result
-        out_img = np.dstack((binaryTopDown, binaryTopDown, binaryTopDown))*255
-        self.imgShape = binaryTopDown.shape
+        out_img = self.outImage(binaryTopDown) if draw else None
         
-        if not self.detected:
-            self.blindSearch(binaryTopDown, out_img)
-        else:
-            found = self.updateLanes(binaryTopDown)
-            if not found:
+        if not found:
+            with stats.stage('blindSearch'):
                 self.blindSearch(binaryTopDown, out_img)
+            stats.count('blindSearch')
         
         # if not enough pixels in left or right, re-mask with wider gates
         if len(self.nonzerox[self.lft_lane_inds]) < 300 or  len(self.nonzerox[self.rgt_lane_inds]) < 100:
-            imgTopMasked = UtilMask.maskPipeline(topDown, l_thresh=180)
-            binaryTopDown = UtilMask.binaryImg(imgTopMasked)
-            out_img = np.dstack((binaryTopDown, binaryTopDown, binaryTopDown))*255
-            self.blindSearch(binaryTopDown, out_img)
+            with stats.stage('mask'):
+                binaryTopDown = frameMask.binary(self.hThresh, self.lThreshRetry)
+            out_img = self.outImage(binaryTopDown) if draw else None
+            with stats.stage('blindSearch'):
+                self.blindSearch(binaryTopDown, out_img)
+            stats.count('remaskFallback')
+            stats.count('blindSearch')
+        
+        stats.count('nonzeroPixels', self.nonzerox.size)
+        stats.count('lftPixels', self.lft_lane_inds.size)
+        stats.count('rgtPixels', self.rgt_lane_inds.size)
         
         if len(self.nonzerox[self.lft_lane_inds]) > 150 and  len(self.nonzerox[self.rgt_lane_inds]) > 150:
-            self.fitLines()
+            with stats.stage('fit'):
+                self.fitLines()
+        else:
+            stats.count('fitSkipped')
+            self.confidence = 0.0
         
-        self.highlightLinePoints(out_img)
+        if draw:
+            self.highlightLinePoints(out_img)
         return out_img
         
     
-    def getLaneFill(self, perspective):
-        """Use the given perspective and project a green "safe" lane area onto a blank image"""
+    def outImage(self, binary):
+        """3-channel copy of the binary image to draw the search on, reused every frame"""
+        out_img = self.pool.get('out_img', binary.shape + (3,))
+        return cv2.merge((binary, binary, binary), dst=out_img)
+    
+    def drawLaneFill(self, image, perspective, α=0.8, β=0.3):
+        """Same result as filling the lane polygon in the top-down view, warping it back with
+            topDownInv() and blending it into 'image' with weighted_img(), drawn in place.
+            The polygon is projected to the camera view with warpMatInv, so only its 
+            bounding box gets filled and blended, the rest of the frame is just scaled.
+        """
+        if not perspective.isSetup:
+            perspective.calcTransform(image)
+        height, width = image.shape[:2]
+        # polygon every few rows in the top-down view, lines stay lines through the warp
+        rows = np.append(np.arange(0, len(self.ploty)-1, 8), len(self.ploty)-1)
+        topWidth = self.imgShape[1]
+        lft = np.stack([np.clip(self.lft_fitx[rows], 0, topWidth), self.ploty[rows]], axis=1)
+        rgt = np.stack([np.clip(self.rgt_fitx[rows], 0, topWidth), self.ploty[rows]], axis=1)
+        pts = np.vstack((lft, np.flipud(rgt))).reshape(-1, 1, 2)
+        pts = cv2.perspectiveTransform(pts, perspective.warpMatInv).reshape(-1, 2)
         
-        # Create an image to draw the lines on
-        warp_zero  = np.zeros(self.imgShape).astype(np.uint8)
-        color_warp = np.dstack((warp_zero, warp_zero, warp_zero))
-
-        # Recast the x and y points into usable format for cv2.fillPoly()
-        pts_lft = np.array([np.transpose(np.vstack([self.lft_fitx, self.ploty]))])
-        pts_rgt = np.array([np.flipud(np.transpose(np.vstack([self.rgt_fitx, self.ploty])))])
-        pts = np.hstack((pts_lft, pts_rgt))
-
-        # Draw the lane onto the warped blank image
-        cv2.fillPoly(color_warp, np.int_([pts]), (0,255, 0))
-
-        # Warp the blank back to original image space
-        newwarp = perspective.topDownInv(color_warp)
-        return newwarp
+        x0, y0 = np.clip(np.floor(pts.min(axis=0)).astype(int), 0, (width, height))
+        x1, y1 = np.clip(np.ceil (pts.max(axis=0)).astype(int) + 1, 0, (width, height))
+        
+        roiBlend = None
+        if x1 > x0 and y1 > y0:
+            fill = self.pool.get('fill', image.shape)[:y1-y0, :x1-x0]
+            fill.fill(0)
+            # 4 bits of sub-pixel precision for the vertices
+            cv2.fillPoly(fill, [np.int32(np.round((pts - (x0, y0))*16))], (0,255, 0), shift=4)
+            roiBlend = self.pool.get('roiBlend', image.shape)[:y1-y0, :x1-x0]
+            cv2.addWeighted(image[y0:y1, x0:x1], α, fill, β, 0, dst=roiBlend)
+        
+        # outside the polygon the blend is just α*image
+        cv2.convertScaleAbs(image, dst=image, alpha=α)
+        if roiBlend is not None:
+            image[y0:y1, x0:x1] = roiBlend
+        return image
     
     def addLaneInfo(self, image):
         """Add annotations for lane curvature and car location"""
@@ -76,32 +166,29 @@ class LaneLines:
         return
 
     
-    def blindSearch(self, binary_warped, out_img):
-        """This function was taken from the lecture notes. Small adaptations to fit my pipeline"""
-        # Assuming you have created a warped binary image called "binary_warped"
+    def blindSearch(self, binary_warped, out_img, margin=100, minpix=50):
+        """Sliding window search from the lecture notes.  Nonzero pixels are bucketed by 
+            window row band once, so each window costs O(band pixels) instead of a scan 
+            over every lit pixel in the image.
+        """
+        height = binary_warped.shape[0]
+        # Choose the number of sliding windows
+        nwindows = 9
+        bands = PixelBands(binary_warped, nwindows)
+        self.nonzeroy = bands.nonzeroy
+        self.nonzerox = bands.nonzerox
+        
         # Take a histogram of the bottom half of the image
-        histogram = np.sum(binary_warped[self.imgShape[0]/2:,:], axis=0)
+        histogram = bands.histogram(height//2)
         # Find the peak of the lft and rgt halves of the histogram
         # These will be the starting point for the lft and rgt lines
-        midpoint = np.int(histogram.shape[0]/2)
-        lftx_base = np.argmax(histogram[:midpoint])
-        rgtx_base = np.argmax(histogram[midpoint:]) + midpoint
+        midpoint = int(histogram.shape[0]/2)
+        lftx_base = int(np.argmax(histogram[:midpoint]))
+        rgtx_base = int(np.argmax(histogram[midpoint:])) + midpoint
 
-        # Choose the number of sliding windows
-        nwindows = 9
-        # Set height of windows
-        window_height = np.int(self.imgShape[0]/nwindows)
-        # Identify the x and y positions of all nonzero pixels in the image
-        nonzero = binary_warped.nonzero()
-        self.nonzeroy = np.array(nonzero[0])
-        self.nonzerox = np.array(nonzero[1])
         # Current positions to be updated for each window
         lftx_current = lftx_base
         rgtx_current = rgtx_base
-        # Set the width of the windows +/- margin
-        margin = 100
-        # Set minimum number of pixels found to recenter window
-        minpix = 50
         # Create empty lists to receive lft and rgt lane pixel indices
         self.lft_lane_inds = []
         self.rgt_lane_inds = []
@@ -109,26 +196,26 @@ class LaneLines:
         # Step through the windows one by one
         for window in range(nwindows):
             # Identify window boundaries in x and y (and rgt and lft)
-            win_y_lo = self.imgShape[0] - (window+1)*window_height
-            win_y_hi = self.imgShape[0] - window*window_height
+            win_y_lo = int(bands.bandLo[window])
+            win_y_hi = int(bands.bandHi[window])
             win_xlft_lo = lftx_current - margin
             win_xlft_hi = lftx_current + margin
             win_xrgt_lo = rgtx_current - margin
             win_xrgt_hi = rgtx_current + margin
             # Draw the windows on the visualization image
-            cv2.rectangle(out_img,(win_xlft_lo,win_y_lo),(win_xlft_hi,win_y_hi),(0,255,0), 2) 
-            cv2.rectangle(out_img,(win_xrgt_lo,win_y_lo),(win_xrgt_hi,win_y_hi),(0,255,0), 2) 
+            if out_img is not None:
+                cv2.rectangle(out_img,(win_xlft_lo,win_y_lo),(win_xlft_hi,win_y_hi),(0,255,0), 2) 
+                cv2.rectangle(out_img,(win_xrgt_lo,win_y_lo),(win_xrgt_hi,win_y_hi),(0,255,0), 2) 
             # Identify the nonzero pixels in x and y within the window
-            good_lft_inds = ((self.nonzeroy >= win_y_lo) & (self.nonzeroy < win_y_hi) & (self.nonzerox >= win_xlft_lo) & (self.nonzerox < win_xlft_hi)).nonzero()[0]
-            good_rgt_inds = ((self.nonzeroy >= win_y_lo) & (self.nonzeroy < win_y_hi) & (self.nonzerox >= win_xrgt_lo) & (self.nonzerox < win_xrgt_hi)).nonzero()[0]
-            # Append these indices to the lists
-            self.lft_lane_inds.append(good_lft_inds)
-            self.rgt_lane_inds.append(good_rgt_inds)
+            self.lft_lane_inds.append(bands.indices(window, win_xlft_lo, win_xlft_hi))
+            self.rgt_lane_inds.append(bands.indices(window, win_xrgt_lo, win_xrgt_hi))
             # If you found > minpix pixels, recenter next window on their mean position
-            if len(good_lft_inds) > minpix:
-                lftx_current = np.int(np.mean(self.nonzerox[good_lft_inds]))
-            if len(good_rgt_inds) > minpix:        
-                rgtx_current = np.int(np.mean(self.nonzerox[good_rgt_inds]))
+            count, xsum = bands.window(window, win_xlft_lo, win_xlft_hi)
+            if count > minpix:
+                lftx_current = int(xsum/count)
+            count, xsum = bands.window(window, win_xrgt_lo, win_xrgt_hi)
+            if count > minpix:
+                rgtx_current = int(xsum/count)
 
         # Concatenate the arrays of indices
         self.lft_lane_inds = np.concatenate(self.lft_lane_inds)
@@ -136,32 +223,113 @@ class LaneLines:
         
         return out_img
     
-    def updateLanes(self, binary_warped):
-        """This function was taken from the lecture notes.  Small adaptations to fit my pipeline"""
-        # Assume you now have a new warped binary image 
-        # from the next frame of video (also called "binary_warped")
-        # It's now much easier to find line pixels!
-        nonzero  = binary_warped.nonzero()
-        nonzeroy = np.array(nonzero[0])
-        nonzerox = np.array(nonzero[1])
-        margin = 100
-        LFit = self.lft_fit
-        RFit = self.rgt_fit
-        lft_lane_inds = ((nonzerox > (LFit[0]*(nonzeroy**2) + LFit[1]*nonzeroy + LFit[2] - margin)) & (nonzerox < (LFit[0]*(nonzeroy**2) + LFit[1]*nonzeroy + LFit[2] + margin)))
-        rgt_lane_inds = ((nonzerox > (RFit[0]*(nonzeroy**2) + RFit[1]*nonzeroy + RFit[2] - margin)) & (nonzerox < (RFit[0]*(nonzeroy**2) + RFit[1]*nonzeroy + RFit[2] + margin)))
-        
-        if lft_lane_inds.size == 0 or rgt_lane_inds.size == 0:
+    def coarseSearch(self, frameMask):
+        """Blind search on a downscaled copy of the top-down image, then refine at full 
+            resolution with updateLanes() in a narrow band around the coarse lines, and 
+            once more with the normal margin around a fit of the refined pixels.
+            Returns the full resolution band binary and whether both lanes were found.
+        """
+        scale = self.coarseScale
+        height, width = self.imgShape
+        small = cv2.resize(frameMask.image, (int(round(width*scale)), int(round(height*scale))), 
+                           interpolation=cv2.INTER_AREA)
+        binarySmall = UtilMask.FrameMask(small).binary(self.hThresh, self.lThresh)
+        
+        # window sizes shrink with the image, pixel counts with its area
+        self.blindSearch(binarySmall, None, margin=max(int(100*scale), 2), minpix=max(int(50*scale*scale), 1))
+        lftx, lfty = self.nonzerox[self.lft_lane_inds], self.nonzeroy[self.lft_lane_inds]
+        rgtx, rgty = self.nonzerox[self.rgt_lane_inds], self.nonzeroy[self.rgt_lane_inds]
+        if len(np.unique(lfty)) < 3 or len(np.unique(rgty)) < 3:
+            return None, False
+        
+        fitter = self.getFitter(binarySmall.shape[0])
+        scalex = binarySmall.shape[1]/width
+        scaley = binarySmall.shape[0]/height
+        previous = {name: getattr(self, name) for name in ('lft_fit', 'rgt_fit') if hasattr(self, name)}
+        self.lft_fit = toFullScale(fitter.fit(lftx, lfty), scalex, scaley)
+        self.rgt_fit = toFullScale(fitter.fit(rgtx, rgty), scalex, scaley)
+        
+        binaryTopDown = frameMask.bandBinary(self.trackSpans(self.refineMargin), self.hThresh, self.lThresh)
+        found = self.updateLanes(binaryTopDown, margin=self.refineMargin)
+        if found:
+            # the coarse lines can be off by more than refineMargin, so pick up the pixels
+            # the full resolution search would have found around the refined lines
+            fitter = self.getFitter(height)
+            self.lft_fit = fitter.fit(self.nonzerox[self.lft_lane_inds], self.nonzeroy[self.lft_lane_inds])
+            self.rgt_fit = fitter.fit(self.nonzerox[self.rgt_lane_inds], self.nonzeroy[self.rgt_lane_inds])
+            binaryTopDown = frameMask.bandBinary(self.trackSpans(), self.hThresh, self.lThresh)
+            found = self.updateLanes(binaryTopDown)
+        if not found:
+            # leave the fits as they were, including not there at all before a first fit
+            for name in ('lft_fit', 'rgt_fit'):
+                if name in previous:
+                    setattr(self, name, previous[name])
+                else:
+                    delattr(self, name)
+        return binaryTopDown, found
+    
+    def updateLanes(self, binary_warped, margin=100):
+        """Update method from the lecture notes.  Each fit is evaluated once per image row, 
+            and only pixels within +/- margin of the previous fits are looked at.
+        """
+        lftx, lfty = self.bandPixels(binary_warped, self.lft_fit, margin)
+        rgtx, rgty = self.bandPixels(binary_warped, self.rgt_fit, margin)
+        
+        if lftx.size == 0 or rgtx.size == 0:
             # update lost the lines, lets do blind search
             self.detected = False
             return False
-        else:
-            self.nonzeroy = nonzeroy
-            self.nonzerox = nonzerox
-            self.lft_lane_inds = lft_lane_inds
-            self.rgt_lane_inds = rgt_lane_inds
-            #print("Update", len(self.nonzerox[self.lft_lane_inds]), len(self.nonzerox[self.rgt_lane_inds]))
+        
+        self.nonzerox = np.concatenate((lftx, rgtx))
+        self.nonzeroy = np.concatenate((lfty, rgty))
+        self.lft_lane_inds = np.arange(lftx.size)
+        self.rgt_lane_inds = np.arange(lftx.size, lftx.size + rgtx.size)
         return True
     
+    def bandLimits(self, fit, margin, height):
+        """Per-row column range lo <= x < hi of pixels strictly within margin of the fit"""
+        rows = np.arange(height)
+        fitx = fit[0]*rows**2 + fit[1]*rows + fit[2]
+        lo = np.floor(fitx - margin).astype(np.intp) + 1
+        hi = np.ceil (fitx + margin).astype(np.intp)
+        return lo, hi
+    
+    def bandPixels(self, binary_warped, fit, margin):
+        """x and y of the lit pixels within +/- margin of the fit, in row-major order"""
+        height, width = binary_warped.shape
+        lo, hi = self.bandLimits(fit, margin, height)
+        
+        # gather a (height, 2*margin) strip that follows the curve, all temporaries are
+        # pool buffers
+        shape = (height, 2*margin)
+        cols  = self.pool.get('bandCols',  shape, np.intp)
+        flat  = self.pool.get('bandFlat',  shape, np.intp)
+        valid = self.pool.get('bandValid', shape, np.bool_)
+        test  = self.pool.get('bandTest',  shape, np.bool_)
+        strip = self.pool.get('bandStrip', shape)
+        
+        np.add(lo[:, None], np.arange(2*margin), out=cols)
+        np.less(cols, hi[:, None], out=valid)
+        valid &= np.greater_equal(cols, 0, out=test)
+        valid &= np.less(cols, width, out=test)
+        np.clip(cols, 0, width-1, out=cols)
+        np.add(cols, (np.arange(height)*width)[:, None], out=flat)
+        np.take(np.ascontiguousarray(binary_warped).reshape(-1), flat, out=strip, mode='clip')
+        
+        np.not_equal(strip, 0, out=test)
+        test &= valid
+        ys, ks = np.nonzero(test)
+        return cols[ys, ks], ys
+    
+    def trackSpans(self, margin=100):
+        """Column spans of the image that hold the tracking bands of both lanes"""
+        height, width = self.imgShape
+        spans = []
+        for fit in (self.lft_fit, self.rgt_fit):
+            lo, hi = self.bandLimits(fit, margin, height)
+            spans.append((int(np.clip(lo.min(), 0, width)), int(np.clip(hi.max(), 0, width))))
+        return spans
+    
     def fitLines(self):
         """Take raw left and right pixels and fit lines to them.  Also compute car location
         and lane curvature.  Most of this taken from class notes."""
@@ -181,13 +349,33 @@ class LaneLines:
             return
         
         # Fit a second order polynomial to each
-        self.lft_fit = np.polyfit(lfty, lftx, 2)
-        self.rgt_fit = np.polyfit(rgty, rgtx, 2)
+        fitter = self.getFitter(self.imgShape[0])
+        lft_fit = fitter.fit(lftx, lfty)
+        rgt_fit = fitter.fit(rgtx, rgty)
+        self.lftCount = len(lftx)
+        self.rgtCount = len(rgtx)
+        
+        if self.adaptive:
+            # score the raw fit, then draw and measure the smoothed one
+            self.confidence = self.fitConfidence(lft_fit, rgt_fit)
+            self.history.add(lft_fit, rgt_fit, self.confidence)
+            lft_fit, rgt_fit = self.history.smoothed()
+        
+        self.setLines(lft_fit, rgt_fit)
+        self.detected = True
+        return
+    
+    def setLines(self, lft_fit, rgt_fit):
+        """Use the given fits as the current lanes.  Also compute car location and lane 
+            curvature.  Most of this taken from class notes."""
+        fitter = self.getFitter(self.imgShape[0])
+        self.lft_fit = lft_fit
+        self.rgt_fit = rgt_fit
     
         # Generate x and y values for plotting
-        self.ploty = np.linspace(0, self.imgShape[0]-1, self.imgShape[0] )
-        self.lft_fitx = self.lft_fit[0]*self.ploty**2 + self.lft_fit[1]*self.ploty + self.lft_fit[2]
-        self.rgt_fitx = self.rgt_fit[0]*self.ploty**2 + self.rgt_fit[1]*self.ploty + self.rgt_fit[2]
+        self.ploty = fitter.ploty
+        self.lft_fitx = fitter.evaluate(self.lft_fit)
+        self.rgt_fitx = fitter.evaluate(self.rgt_fit)
         
         # generate lines
         self.lftLine = np.int32(np.stack([self.lft_fitx, self.ploty], axis=1))
@@ -201,23 +389,78 @@ class LaneLines:
         self.laneWidth  = laneWidthPx  *xm_per_pix
         self.laneOffset = laneOffsetPx *xm_per_pix
         
-        # Fit new polynomials to x,y in world space
-        lft_fit_cr = np.polyfit(self.ploty*ym_per_pix, self.lft_fitx*xm_per_pix, 2)
-        rgt_fit_cr = np.polyfit(self.ploty*ym_per_pix, self.rgt_fitx*xm_per_pix, 2)
+        # Scale the pixel fits to world space, x = A*y^2 + B*y + C becomes
+        # x_m = (xm/ym^2)*A*y_m^2 + (xm/ym)*B*y_m + xm*C
+        lft_fit_cr = worldFit(self.lft_fit)
+        rgt_fit_cr = worldFit(self.rgt_fit)
         # Calculate the new radii of curvature
-        y_eval = np.max(self.ploty)
+        y_eval = self.ploty[-1]
         lft_curverad = ((1 + (2*lft_fit_cr[0]*y_eval*ym_per_pix + lft_fit_cr[1])**2)**1.5) / np.absolute(2*lft_fit_cr[0])
         rgt_curverad = ((1 + (2*rgt_fit_cr[0]*y_eval*ym_per_pix + rgt_fit_cr[1])**2)**1.5) / np.absolute(2*rgt_fit_cr[0])
         #print("-- Curvatures: ", lft_curverad, rgt_curverad)
         
         # calculate weighted average
-        curveTot = lft_curverad*len(lftx) + rgt_curverad*len(rgtx)
-        self.curveRadKm = curveTot/(len(lftx) + len(rgtx))/1000
+        curveTot = lft_curverad*self.lftCount + rgt_curverad*self.rgtCount
+        self.curveRadKm = curveTot/(self.lftCount + self.rgtCount)/1000
         #print("  --  Avg Radius = {0:6.2f} km,  Lane Width = {1:.1f} m,   Lane Offset = {2:.1f} m".format(self.curveRadKm, self.laneWidth, self.laneOffset))
-        
-        self.detected = True
         return
     
+    def fitConfidence(self, lft_fit, rgt_fit):
+        """0-1 score of a new fit: enough lane pixels, a steady lane width all along the 
+            lane, and agreement with the recent history.  The width is compared with the
+            lane's own recent width, or its median along the rows without a history, as 
+            the measured width depends on the warp and the camera.
+        """
+        fitter = self.getFitter(self.imgShape[0])
+        lft_fitx = fitter.evaluate(lft_fit)
+        rgt_fitx = fitter.evaluate(rgt_fit)
+        
+        pixels = min(1.0, min(self.lftCount, self.rgtCount)/1000.0)
+        widths = (rgt_fitx - lft_fitx)*xm_per_pix
+        agree  = 1.0
+        if self.history.count:
+            lft_prev, rgt_prev = self.history.smoothed()
+            lft_prevx = fitter.evaluate(lft_prev)
+            rgt_prevx = fitter.evaluate(rgt_prev)
+            recent = ((rgt_prevx - lft_prevx)*xm_per_pix).mean()
+            shift = max(np.abs(lft_fitx - lft_prevx).mean(), np.abs(rgt_fitx - rgt_prevx).mean())
+            agree = np.exp(-(shift/40.0)**2)
+        else:
+            recent = np.median(widths)
+        width = np.exp(-((np.abs(widths - recent).max())/0.7)**2)
+        return float(pixels*width*agree)
+    
+    def needsDetection(self):
+        """Adaptive scheduling: False when the lanes have been stable long enough that this
+            frame can reuse the predicted fit (at most every other frame).
+        """
+        if not self.adaptive or not self.detected or self.coasted:
+            return True
+        return not self.history.stable(self.highConfidence, self.stableFrames)
+    
+    def willCoast(self, ahead):
+        """Expected needsDetection() result, negated, for the frame 'ahead' frames after the
+            last one processed, if the lanes stay stable.  Lets frames that are dispatched 
+            early (e.g. to a process pool) skip the work a coasting frame does not need.
+        """
+        if ahead < 1 or not self.adaptive or not self.detected:
+            return False
+        if not self.history.stable(self.highConfidence, self.stableFrames):
+            return False
+        # coasting alternates with detection while stable
+        return (ahead % 2 == 1) != self.coasted
+    
+    def coast(self):
+        """Skip detection for this frame and show the predicted lanes"""
+        self.setLines(*self.history.predicted())
+        self.coasted = True
+    
+    def getFitter(self, height):
+        """Quadratic fitter with its row tables cached for the image height"""
+        if height not in self.fitters:
+            self.fitters[height] = MomentFit(height)
+        return self.fitters[height]
+    
     def highlightLinePoints(self, out_img):
         """For debugging, we color the left and right lane raw pixels, and draw the curve fit."""
         out_img[self.nonzeroy[self.lft_lane_inds], self.nonzerox[self.lft_lane_inds]] = [255, 0, 0]
@@ -225,5 +468,135 @@ class LaneLines:
         
         cv2.polylines(out_img, [self.lftLine, self.rgtLine], False, (255,255,255), thickness=1)
         return out_img
+
+
+def toFullScale(fit, scalex, scaley):
+    """Fit made on a downscaled image converted to full resolution pixels.  With 
+        y_small = scaley*y and x = x_small/scalex, x = (a*sy^2*y^2 + b*sy*y + c)/sx.
+    """
+    return np.array([fit[0]*scaley*scaley, fit[1]*scaley, fit[2]])/scalex
+
+def worldFit(fit):
+    """Pixel space fit coefficients converted to meters"""
+    return np.array([fit[0]*xm_per_pix/ym_per_pix**2, fit[1]*xm_per_pix/ym_per_pix, fit[2]*xm_per_pix])
+
+
+class FitHistory:
+    """Fixed-size ring buffer of the most recent left/right fits and their confidence"""
+    def __init__(self, size=8):
+        self.fits       = np.zeros((size, 2, 3))
+        self.confidence = np.zeros(size)
+        self.next  = 0
+        self.count = 0
+    
+    def add(self, lft_fit, rgt_fit, confidence):
+        self.fits[self.next, 0] = lft_fit
+        self.fits[self.next, 1] = rgt_fit
+        self.confidence[self.next] = confidence
+        self.next  = (self.next + 1) % len(self.confidence)
+        self.count = min(self.count + 1, len(self.confidence))
+    
+    def recent(self, n):
+        """Ring indices of the last n entries, newest first"""
+        return (self.next - 1 - np.arange(min(n, self.count))) % len(self.confidence)
+    
+    def smoothed(self):
+        """Confidence weighted mean of the stored fits, newer fits weigh a bit more"""
+        idx = self.recent(self.count)
+        weights = self.confidence[idx] * 0.8**np.arange(len(idx)) + 1e-6
+        fits = np.tensordot(weights, self.fits[idx], axes=1)/weights.sum()
+        return fits[0], fits[1]
+    
+    def predicted(self):
+        """smoothed() moved on by the average per-frame change over the stored fits"""
+        lft_fit, rgt_fit = self.smoothed()
+        if self.count < 2:
+            return lft_fit, rgt_fit
+        idx = self.recent(self.count)
+        step = (self.fits[idx[0]] - self.fits[idx[-1]])/(len(idx) - 1)
+        return lft_fit + step[0], rgt_fit + step[1]
+    
+    def stable(self, minConfidence, n):
+        """True if the last n fits all have at least 'minConfidence'"""
+        return self.count >= n and bool(np.all(self.confidence[self.recent(n)] >= minConfidence))
+
+
+class MomentFit:
+    """Least squares fit of x = A*y^2 + B*y + C by solving the 3x3 normal equations from 
+        accumulated moments, instead of np.polyfit building a Vandermonde matrix and an SVD
+        on every call.  Pixel rows are integers, so the moments come from per-row pixel 
+        counts and x sums dotted with a cached table of row powers.  Rows are scaled by 
+        1/height to keep the normal equations well conditioned.
+    """
+    def __init__(self, height):
+        self.height = height
+        self.ploty  = np.linspace(0, height-1, height)
+        t = self.ploty/height
+        self.tPowers = np.stack([np.ones_like(t), t, t**2, t**3, t**4], axis=1)
+        self.yPowers = np.stack([self.ploty**2, self.ploty, np.ones_like(self.ploty)], axis=1)
+    
+    def fit(self, xs, ys):
+        counts = np.bincount(ys, minlength=self.height)
+        xsums  = np.bincount(ys, weights=xs, minlength=self.height)
+        S = counts.dot(self.tPowers)          # sum t^0 .. t^4
+        R = xsums.dot(self.tPowers[:, :3])    # sum x*t^0 .. x*t^2
+        if np.count_nonzero(counts) < 3:
+            # the quadratic is not determined by fewer than 3 distinct rows, let polyfit 
+            # pick its least squares solution
+            return np.polyfit(ys, xs, 2)
+        normal = np.array([[S[4], S[3], S[2]],
+                           [S[3], S[2], S[1]],
+                           [S[2], S[1], S[0]]])
+        a, b, c = np.linalg.solve(normal, R[::-1])
+        scale = 1.0/self.height
+        return np.array([a*scale*scale, b*scale, c])
+    
+    def evaluate(self, fit):
+        """x of the fit at every image row"""
+        return self.yPowers.dot(fit)
+
+
+class PixelBands:
+    """Nonzero pixels of a binary image bucketed into horizontal row bands, with per-band
+        column prefix sums so the pixel count and mean x of any window are O(1).  Band 0 
+        is at the bottom of the image, matching the search windows.
+    """
+    def __init__(self, binary, nbands):
+        height, width = binary.shape
+        # nonzero() walks the image row by row, so pixels are already sorted by y
+        self.nonzeroy, self.nonzerox = binary.nonzero()
+        self.width = width
+        
+        bandHeight  = int(height/nbands)
+        self.bandLo = height - (np.arange(nbands)+1)*bandHeight
+        self.bandHi = height -  np.arange(nbands)   *bandHeight
+        self.starts = np.searchsorted(self.nonzeroy, self.bandLo)
+        self.ends   = np.searchsorted(self.nonzeroy, self.bandHi)
+        
+        # prefix sums of pixel count and x per column, with a leading 0 column
+        self.countSum = np.zeros((nbands, width+1), np.int64)
+        self.xSum     = np.zeros((nbands, width+1), np.int64)
+        columns = np.arange(width, dtype=np.int64)
+        for band in range(nbands):
+            counts = np.bincount(self.nonzerox[self.starts[band]:self.ends[band]], minlength=width)
+            np.cumsum(counts,         out=self.countSum[band, 1:])
+            np.cumsum(counts*columns, out=self.xSum[band, 1:])
+    
+    def histogram(self, rowStart):
+        """Count of lit pixels per column for rows >= rowStart"""
+        start = np.searchsorted(self.nonzeroy, rowStart)
+        return np.bincount(self.nonzerox[start:], minlength=self.width)
     
+    def window(self, band, xlo, xhi):
+        """Pixel count and sum of x for lo <= x < hi inside the band"""
+        xlo = min(max(xlo, 0), self.width)
+        xhi = min(max(xhi, xlo), self.width)
+        count = self.countSum[band, xhi] - self.countSum[band, xlo]
+        xsum  = self.xSum[band, xhi]     - self.xSum[band, xlo]
+        return int(count), int(xsum)
     
+    def indices(self, band, xlo, xhi):
+        """Indices into nonzerox/nonzeroy of the pixels with lo <= x < hi inside the band"""
+        start = self.starts[band]
+        xs = self.nonzerox[start:self.ends[band]]
+        return np.flatnonzero((xs >= xlo) & (xs < xhi)) + start
@@ -1,9 +1,7 @@
 import os
 import numpy as np
 import cv2
-import glob
-import matplotlib.pyplot as plt
-import matplotlib.image as mpimg
+import UtilImage
 
 class Perspective:
     """Class to memorize a top-down perspective transform and apply it when needed."""
@@ -34,18 +32,20 @@ class Perspective:
         self.warpMatInv = cv2.getPerspectiveTransform(self.dest,   self.source)
         self.isSetup = True
     
-    def topDown(self, image):
+    def topDown(self, image, dst=None):
+        """Birds-eye view of 'image', written into 'dst' if given"""
         if not self.isSetup:
             self.calcTransform(image)
         
-        topDownImg = cv2.warpPerspective(image, self.warpMat, self.shape, flags=cv2.INTER_LINEAR)
+        topDownImg = cv2.warpPerspective(image, self.warpMat, self.shape, dst=dst, flags=cv2.INTER_LINEAR)
         return topDownImg
         
-    def topDownInv(self, image):
+    def topDownInv(self, image, dst=None):
+        """Camera view of a birds-eye 'image', written into 'dst' if given"""
         if not self.isSetup:
             self.calcTransform(image)
         
-        topDownImgInv = cv2.warpPerspective(image, self.warpMatInv, self.shape, flags=cv2.INTER_LINEAR)
+        topDownImgInv = cv2.warpPerspective(image, self.warpMatInv, self.shape, dst=dst, flags=cv2.INTER_LINEAR)
         return topDownImgInv
     
     def testTransform(self, image):
@@ -135,18 +135,251 @@ def maskPipeline(image, ksize=5, \
     color_binary = np.dstack(( np.zeros_like(combined), combined, mask_color))
         
     return color_binary
+
+
+# Fraction of pixels that maskPipelineFast() may disagree with maskPipeline() on.  The
+# fast path uses exact integer thresholds, while the original rounds through float64 and
+# truncates to uint8, so results only differ on pixels sitting exactly on a threshold.
+FAST_MASK_TOLERANCE = 1e-3
+
+def maskPipelineFast(image, ksize=5, \
+                    abs_thresh=(50, 200), \
+                    mag_thresh=(80, 200), \
+                    dir_thresh=(0.7, 1.3), \
+                    h_thresh  =(15, 30), \
+                    l_thresh  = 210):
+    
+    """Same mask as maskPipeline() with far less work.  Gradients stay in int16, the
+        magnitude test compares squared values, and the direction test compares tangents.
+    """
+    return FrameMask(image, ksize).mask(abs_thresh, mag_thresh, dir_thresh, h_thresh, l_thresh)
+
+
+class FrameMask:
+    """Lazily evaluated mask for one frame.  Gray, Sobel and HLS planes are only computed
+        the first time something needs them, and each threshold result is cached, so 
+        re-thresholding (e.g. a lower l_thresh) only costs the final compare.  If a 
+        BufferPool is given, the planes used for lane finding are written into its arrays.
+    """
+    def __init__(self, image, ksize=5, pool=None):
+        self.image = image
+        self.ksize = ksize
+        self.pool  = pool
+        self._gray  = None
+        self._sobel = None
+        self._mag2  = None
+        self._hls   = None
+        self.cache  = {}
+    
+    def gray(self):
+        if self._gray is None:
+            self._gray = cv2.cvtColor(self.image, cv2.COLOR_RGB2GRAY)
+        return self._gray
+    
+    def sobel(self):
+        """Absolute x and y gradients.  8-bit input with ksize <= 5 can not overflow int16."""
+        if self._sobel is None:
+            sobelx = cv2.Sobel(self.gray(), cv2.CV_16S, 1, 0, ksize=self.ksize)
+            sobely = cv2.Sobel(self.gray(), cv2.CV_16S, 0, 1, ksize=self.ksize)
+            np.absolute(sobelx, out=sobelx)
+            np.absolute(sobely, out=sobely)
+            self._sobel = (sobelx, sobely)
+        return self._sobel
+    
+    def mag2(self):
+        """Squared gradient magnitude"""
+        if self._mag2 is None:
+            abs_sobelx, abs_sobely = self.sobel()
+            self._mag2 = np.square(abs_sobelx, dtype=np.int32)
+            self._mag2 += np.square(abs_sobely, dtype=np.int32)
+        return self._mag2
+    
+    def hls(self):
+        if self._hls is None:
+            self._hls = cv2.cvtColor(self.image, cv2.COLOR_RGB2HLS, dst=self.buffer('hls', self.image.shape))
+        return self._hls
+    
+    def seedPlanes(self, sobel=None, hls=None):
+        """Hand over (abs_sobelx, abs_sobely) and/or HLS planes computed earlier (e.g. loaded
+            from a cache), so they are not computed again
+        """
+        if sobel is not None:
+            self._sobel = tuple(sobel)
+        if hls is not None:
+            self._hls = hls
+    
+    def buffer(self, name, shape):
+        """uint8 output array, reused from the pool if there is one"""
+        if self.pool is None:
+            return None
+        return self.pool.get(name, shape)
+    
+    def cached(self, key, func, *args):
+        if key not in self.cache:
+            self.cache[key] = func(*args)
+        return self.cache[key]
+    
+    def gradientMask(self, abs_thresh=(50, 200), mag_thresh=(80, 200), dir_thresh=(0.7, 1.3)):
+        """Green channel of maskPipeline(): (abs x & abs y) | (magnitude & direction)"""
+        key = ('grad', tuple(abs_thresh), tuple(mag_thresh), tuple(dir_thresh))
+        return self.cached(key, self._gradientMask, abs_thresh, mag_thresh, dir_thresh)
+    
+    def _gradientMask(self, abs_thresh, mag_thresh, dir_thresh):
+        abs_sobelx, abs_sobely = self.sobel()
+        absMask = absThreshMask(abs_sobelx, abs_sobely, abs_thresh)
+        magMask = magThreshMask(self.mag2(), mag_thresh)
+        cv2.bitwise_and(magMask, dirThreshMask(abs_sobelx, abs_sobely, dir_thresh), dst=magMask)
+        return cv2.bitwise_or(absMask, magMask, dst=absMask)
+    
+    def colorMask(self, h_thresh=(15, 30), l_thresh=210):
+        """Blue channel of maskPipeline(), this is the binary image used for lane finding"""
+        key = ('color', tuple(h_thresh), l_thresh)
+        return self.cached(key, self._colorMask, h_thresh, l_thresh)
+    
+    def _colorMask(self, h_thresh, l_thresh):
+        shape  = self.image.shape[:2]
+        yellowKey, lightKey = ('yellow', tuple(h_thresh)), ('light', l_thresh)
+        yellow = self.cached(yellowKey, yellowMask, self.hls(), h_thresh, self.buffer(yellowKey, shape))
+        light  = self.cached(lightKey,  lightMask,  self.hls(), l_thresh, self.buffer(lightKey, shape))
+        return cv2.bitwise_or(yellow, light, dst=self.buffer(('color', tuple(h_thresh), l_thresh), shape))
+    
+    def binary(self, h_thresh=(15, 30), l_thresh=210):
+        """Same as binaryImg(maskPipeline(...)), without computing any gradients"""
+        return self.colorMask(h_thresh, l_thresh)
+    
+    def seed(self, binary, h_thresh=(15, 30), l_thresh=210):
+        """Hand over a binary() result that was computed elsewhere (e.g. a worker process)"""
+        self.cache[('color', tuple(h_thresh), l_thresh)] = binary
+    
+    def bandBinary(self, colSpans, h_thresh=(15, 30), l_thresh=210):
+        """Binary image computed only inside the given (lo, hi) column spans, zero elsewhere.
+            Falls back to the full binary if it is known or the HLS plane is already computed.
+        """
+        if self._hls is not None or ('color', tuple(h_thresh), l_thresh) in self.cache:
+            return self.binary(h_thresh, l_thresh)
+        
+        if self.pool is None:
+            binary = np.zeros(self.image.shape[:2], np.uint8)
+            for lo, hi in mergeSpans(colSpans):
+                hls = cv2.cvtColor(self.image[:, lo:hi], cv2.COLOR_RGB2HLS)
+                binary[:, lo:hi] = cv2.bitwise_or(yellowMask(hls, h_thresh), lightMask(hls, l_thresh))
+            return binary
+        
+        # same thing written into column slices of full size pool buffers
+        shape  = self.image.shape[:2]
+        hlsBuf = self.pool.get('bandHls', self.image.shape)
+        yellow = self.pool.get('bandYellow', shape)
+        light  = self.pool.get('bandLight', shape)
+        binary = self.pool.get('bandBinary', shape)
+        binary.fill(0)
+        for lo, hi in mergeSpans(colSpans):
+            hls = cv2.cvtColor(self.image[:, lo:hi], cv2.COLOR_RGB2HLS, dst=hlsBuf[:, lo:hi])
+            cv2.bitwise_or(yellowMask(hls, h_thresh, yellow[:, lo:hi]), lightMask(hls, l_thresh, light[:, lo:hi]), 
+                           dst=binary[:, lo:hi])
+        return binary
+    
+    def mask(self, abs_thresh=(50, 200), mag_thresh=(80, 200), dir_thresh=(0.7, 1.3), h_thresh=(15, 30), l_thresh=210):
+        """Full 3-channel mask, identical layout to maskPipeline()"""
+        combined   = self.gradientMask(abs_thresh, mag_thresh, dir_thresh)
+        mask_color = self.colorMask(h_thresh, l_thresh)
+        return cv2.merge((np.zeros_like(combined), combined, mask_color))
+
+
+def mergeSpans(spans):
+    """Sort and merge overlapping (lo, hi) spans, dropping empty ones"""
+    merged = []
+    for lo, hi in sorted(spans):
+        if hi <= lo:
+            continue
+        if merged and lo <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], hi))
+        else:
+            merged.append((lo, hi))
+    return merged
+
+def _ceilDiv(num, den):
+    return -(-num // den)
+
+def absThreshMask(abs_sobelx, abs_sobely, abs_thresh):
+    """Both |sobel| scaled to 0-255 are inside abs_thresh.  uint8(255*a/max) >= lo is the
+        same as a >= ceil(lo*max/255) for integer a, and <= hi is a < ceil((hi+1)*max/255).
+    """
+    masks = []
+    for abs_sobel in (abs_sobelx, abs_sobely):
+        maxVal = int(abs_sobel.max())
+        if maxVal == 0:
+            return np.zeros(abs_sobel.shape, np.uint8)
+        lo = _ceilDiv(int(abs_thresh[0])*maxVal, 255)
+        hi = _ceilDiv((int(abs_thresh[1])+1)*maxVal, 255) - 1
+        masks.append(cv2.inRange(abs_sobel, lo, hi))
+    return cv2.bitwise_and(masks[0], masks[1], dst=masks[0])
+
+def magThreshMask(mag2, mag_thresh):
+    """Scaled gradient magnitude inside mag_thresh, tested on the squared magnitude"""
+    maxVal = int(mag2.max())
+    if maxVal == 0:
+        return np.zeros(mag2.shape, np.uint8)
+    # scaled >= lo  <=>  mag2 >= lo^2*max2/255^2,  scaled <= hi  <=>  mag2 < (hi+1)^2*max2/255^2
+    lo = int(np.ceil(mag_thresh[0]**2 * maxVal / 255.0**2))
+    hi = int(np.ceil((mag_thresh[1]+1)**2 * maxVal / 255.0**2)) - 1
+    return cv2.inRange(mag2, lo, hi)
+
+def dirThreshMask(abs_sobelx, abs_sobely, dir_thresh):
+    """arctan2(|sy|, |sx|) inside dir_thresh, tested as tan(lo)*|sx| <= |sy| <= tan(hi)*|sx|"""
+    absx = abs_sobelx.astype(np.float32)
+    absy = abs_sobely.astype(np.float32)
+    mask = np.full(absx.shape, 255, np.uint8)
+    if dir_thresh[0] > 0:
+        # arctan2(0, 0) is 0, so flat pixels never pass a positive lower bound
+        cv2.bitwise_and(mask, cv2.compare(absy, absx*np.float32(np.tan(dir_thresh[0])), cv2.CMP_GE), dst=mask)
+        mask[abs_sobely == 0] = 0
+    if dir_thresh[1] < np.pi/2:
+        cv2.bitwise_and(mask, cv2.compare(absy, absx*np.float32(np.tan(dir_thresh[1])), cv2.CMP_LE), dst=mask)
+    return mask
+
+# yellowMask() lightness range and lowest saturation, both inclusive
+YELLOW_L = (131, 179)
+YELLOW_S = 101
+
+def yellowMask(hls, h_thresh, dst=None):
+    """Hue inside h_thresh with mid lightness and high saturation"""
+    return cv2.inRange(hls, (int(h_thresh[0]), YELLOW_L[0], YELLOW_S), (int(h_thresh[1]), YELLOW_L[1], 255), dst=dst)
+
+def lightMask(hls, l_thresh, dst=None):
+    """Lightness above l_thresh"""
+    return cv2.inRange(hls, (0, int(np.floor(l_thresh))+1, 0), (255, 255, 255), dst=dst)
+
+def checkFastMask(dirName="test_images/"):
+    """Compare maskPipelineFast() to maskPipeline() on the test images"""
+    worst = 0.0
+    for fileName in sorted(os.listdir(dirName)):
+        if 'jpg' not in fileName:
+            continue
+        image = UtilImage.imread(os.path.join(dirName, fileName))
+        for l_thresh in (210, 180):
+            ref  = maskPipeline(image, l_thresh=l_thresh)
+            fast = maskPipelineFast(image, l_thresh=l_thresh)
+            diff = np.count_nonzero(ref != fast) / ref.size
+            worst = max(worst, diff)
+            print("  {:20s} l_thresh={}  mismatch = {:.2e}".format(fileName, l_thresh, diff))
+    print("Worst mismatch {:.2e}, tolerance {:.0e}".format(worst, FAST_MASK_TOLERANCE))
+    return worst <= FAST_MASK_TOLERANCE
     
 
 if __name__ == '__main__':
+    import sys
+    if len(sys.argv) > 1 and sys.argv[1] == 'check':
+        sys.exit(0 if checkFastMask() else 1)
+
     fileNames = os.listdir("test_images/")
     for fileName in fileNames:
         if 'jpg' not in fileName:
             continue
         print("Processing: ", fileName)
         fullName = os.path.join("test_images",fileName)
-        image = mpimg.imread(fullName)
+        image = UtilImage.imread(fullName)
         result = maskPipeline(image)
-        mpimg.imsave(os.path.join("test_images/outputs/", fileName+",mask.jpg"), result)
+        UtilImage.imsave(os.path.join("test_images/outputs/", fileName+",mask.jpg"), result)
         final = weighted_img(result, image)
-        mpimg.imsave(os.path.join("test_images/outputs/", fileName+",final.jpg"), final)
+        UtilImage.imsave(os.path.join("test_images/outputs/", fileName+",final.jpg"), final)
 
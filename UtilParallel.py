@@ -0,0 +1,115 @@
+import os
+import time
+import collections
+import multiprocessing
+import numpy as np
+from UtilStats import stats
+
+def prepareWorker(task):
+    """Stateless pipeline stages for frame number 'idx'.  Each worker process imports its
+        own copy of main, so the calibration and perspective are loaded once per worker.
+        A frame expected to coast only gets un-distorted.
+    """
+    import main
+    idx, image, coast = task
+    if coast:
+        return idx, main.camera.undistort(image, main.buffers.get('imgUD', image.shape)), None, None
+    imgUD, topDown, frameMask = main.prepareFrame(image)
+    return idx, imgUD, topDown, frameMask.binary()
+
+def initWorker(settings):
+    """Import main once per worker, match the parent's options, and load the calibration
+        and remap tables
+    """
+    import main
+    stats.detach()
+    main.applySettings(settings)
+    main.camera.loadMaps()
+
+def orderedMap(func, items, workers, maxPending=None, initializer=None, initargs=()):
+    """Apply 'func' to each item on a process pool and yield the results in input order.
+        At most 'maxPending' items are in flight, so a slow consumer holds back the reader.
+    """
+    if maxPending is None:
+        maxPending = 2*workers
+    with multiprocessing.Pool(workers, initializer=initializer, initargs=initargs) as pool:
+        pending = collections.deque()
+        for item in items:
+            pending.append(pool.apply_async(func, (item,)))
+            if len(pending) >= maxPending:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+def laneFits(lanes):
+    """Both lane fits of the current frame as 6 numbers, NaN before the first detection"""
+    if not hasattr(lanes, 'lft_fit'):
+        return np.full(6, np.nan)
+    return np.concatenate([lanes.lft_fit, lanes.rgt_fit])
+
+def segmentWorker(task):
+    """Run the pipeline over frames [start, stop) of a movie with fresh LaneLines and 
+        encode them to their own file.  Decoding starts 'warmup' frames before 'start' 
+        so tracking has settled by the first written frame, the warm-up frames are not 
+        written.  'stop' None runs to the end.  Returns the fits of the written frames, 
+        and with 'withStats' the stats of those frames for stats.merge(), else None.
+    """
+    import main
+    import UtilLines
+    import UtilVideo
+    movieName, outName, start, stop, warmup, settings, withStats, withTrace = task
+    stats.detach()
+    main.applySettings(settings)
+    main.laneLines = UtilLines.LaneLines()
+    
+    first = max(0, start - warmup)
+    reader = UtilVideo.FrameReader(movieName, start=first, count=None if stop is None else stop - first)
+    fits = []
+    with UtilVideo.FrameWriter(outName, reader.size, reader.fps) as writer:
+        for idx, frame in enumerate(reader.frames(), first):
+            if idx == start and withStats:
+                # warm-up frames are not counted
+                stats.enable(keepFrames=withTrace)
+            result = main.imagePipeline(frame)
+            if idx >= start:
+                writer.write(result)
+                fits.append(laneFits(main.laneLines))
+    collected = stats.collected() if stats.enabled else None
+    stats.detach()
+    return np.array(fits).reshape(-1, 6), collected
+
+def batchWorker(task):
+    """Run the pipeline on one still image and return its manifest entry"""
+    import main
+    import UtilLines
+    import UtilImage
+    fullName, outName = task
+    entry = {'file': fullName}
+    start = time.perf_counter()
+    try:
+        image = UtilImage.imread(fullName)
+        main.laneLines = UtilLines.LaneLines() # stills are unrelated, no tracking
+        result = main.imagePipeline(image)
+        if outName:
+            os.makedirs(os.path.dirname(outName), exist_ok=True)
+            UtilImage.imsave(outName, result)
+        lanes = main.laneLines
+        entry.update({'curveRadKm': float(lanes.curveRadKm), 'laneOffset': float(lanes.laneOffset), 
+                      'laneWidth': float(lanes.laneWidth), 'detected': bool(lanes.detected)})
+    except Exception as e:
+        entry['error'] = repr(e)
+    entry['ms'] = (time.perf_counter() - start)*1000
+    return entry
+
+def batchMap(tasks, workers, settings):
+    """Yield manifest entries for (inputName, outputName) tasks as they finish.  
+        'settings' are main.pipelineSettings() of the caller.
+    """
+    if workers <= 0:
+        initWorker(settings)
+        for task in tasks:
+            yield batchWorker(task)
+        return
+    with multiprocessing.Pool(workers, initializer=initWorker, initargs=(settings,)) as pool:
+        for entry in pool.imap_unordered(batchWorker, tasks, chunksize=8):
+            yield entry
@@ -0,0 +1,252 @@
+import json
+import time
+import argparse
+import threading
+import collections
+import concurrent.futures
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import numpy as np
+import cv2
+
+import UtilCamera
+import UtilMask
+import UtilLines
+import UtilBuffers
+import UtilParallel
+
+class Stream:
+    """Everything that belongs to one camera feed: its perspective, lane tracking, frame
+        buffers, the frames waiting to be processed, and its latency numbers.
+    """
+    def __init__(self, streamId, latencySamples=1000):
+        self.id          = streamId
+        self.perspective = UtilMask.Perspective()
+        self.laneLines   = UtilLines.LaneLines()
+        self.buffers     = UtilBuffers.BufferPool()
+        self.queue       = collections.deque()
+        self.pending     = 0     # queued frames plus the one being processed
+        self.running     = False
+        self.frames      = 0
+        self.rejected    = 0
+        self.latency     = collections.deque(maxlen=latencySamples) # receipt to result, ms
+        self.process     = collections.deque(maxlen=latencySamples) # pipeline only, ms
+
+
+class LaneService:
+    """Lane finding for many streams in one long running process.  The calibration and
+        remap tables are loaded once and one thread pool is shared by all streams.  Each
+        stream's frames run one at a time in arrival order, so its tracking state is
+        never touched by two threads.  A stream with 'maxPending' frames waiting or in 
+        progress is busy and further frames are rejected until it catches up.
+    """
+    def __init__(self, workers=4, maxPending=2, warmSize=(1280, 720), fusedWarp=False):
+        self.camera     = UtilCamera.Camera()
+        self.fusedWarp  = fusedWarp
+        self.executor   = concurrent.futures.ThreadPoolExecutor(workers)
+        self.maxPending = maxPending
+        self.streams    = {}
+        self.lock       = threading.Lock()
+        self.started    = time.time()
+        if warmSize:
+            # build the shared remap tables now instead of on the first frame
+            perspective = UtilMask.Perspective()
+            perspective.calcTransform(np.zeros((warmSize[1], warmSize[0], 3), np.uint8))
+            self.camera.getUndistortMaps(warmSize)
+            if fusedWarp:
+                self.camera.getWarpMaps(perspective.warpMat, perspective.shape)
+
+    def getStream(self, streamId):
+        with self.lock:
+            stream = self.streams.get(streamId)
+            if stream is None:
+                stream = Stream(streamId)
+                self.streams[streamId] = stream
+            return stream
+
+    def removeStream(self, streamId):
+        with self.lock:
+            return self.streams.pop(streamId, None) is not None
+
+    def submit(self, streamId, image):
+        """Queue an RGB frame for a stream.  Returns a Future for the result dict, or None
+            if the stream is busy.
+        """
+        stream = self.getStream(streamId)
+        future = concurrent.futures.Future()
+        with self.lock:
+            if stream.pending >= self.maxPending:
+                stream.rejected += 1
+                return None
+            stream.pending += 1
+            stream.queue.append((image, future, time.perf_counter()))
+            if not stream.running:
+                stream.running = True
+                self.executor.submit(self.drain, stream)
+        return future
+
+    def drain(self, stream):
+        """Process a stream's queued frames in order, on one pool thread at a time"""
+        while True:
+            with self.lock:
+                if not stream.queue:
+                    stream.running = False
+                    return
+                image, future, received = stream.queue.popleft()
+            start = time.perf_counter()
+            try:
+                result = self.processFrame(stream, image)
+            except Exception as e:
+                with self.lock:
+                    stream.pending -= 1
+                future.set_exception(e)
+                continue
+            done = time.perf_counter()
+            with self.lock:
+                stream.pending -= 1
+                stream.frames += 1
+                stream.process.append((done - start)*1000)
+                stream.latency.append((done - received)*1000)
+                result['frame'] = stream.frames - 1
+            result['ms'] = (done - received)*1000
+            future.set_result(result)
+
+    def processFrame(self, stream, image):
+        """Headless pipeline on the stream's own state, see main.telemetryFrame()"""
+        lanes = stream.laneLines
+        if not lanes.needsDetection():
+            lanes.coast()
+        else:
+            if self.fusedWarp:
+                topDown = self.camera.topDown(image, stream.perspective, stream.buffers.get('topDown', image.shape))
+            else:
+                imgUD   = self.camera.undistort(image, stream.buffers.get('imgUD', image.shape))
+                topDown = stream.perspective.topDown(imgUD, stream.buffers.get('topDown', image.shape))
+            frameMask = UtilMask.FrameMask(topDown, pool=stream.buffers)
+            lanes.processFrame(topDown, frameMask=frameMask, draw=False)
+        fits = UtilParallel.laneFits(lanes)
+        measured = hasattr(lanes, 'curveRadKm')
+        return {'stream': stream.id, 'detected': bool(lanes.detected),
+                'lft_fit': None if np.isnan(fits[0]) else fits[:3].tolist(),
+                'rgt_fit': None if np.isnan(fits[3]) else fits[3:].tolist(),
+                'curveRadKm': float(lanes.curveRadKm) if measured else None,
+                'laneOffset': float(lanes.laneOffset) if measured else None,
+                'laneWidth':  float(lanes.laneWidth)  if measured else None}
+
+    def metrics(self):
+        with self.lock:
+            streams = {}
+            for streamId, stream in self.streams.items():
+                entry = {'frames': stream.frames, 'rejected': stream.rejected, 'pending': stream.pending}
+                for name, samples in (('latency', stream.latency), ('process', stream.process)):
+                    if samples:
+                        ms = np.array(samples)
+                        entry[name+'_p50_ms'] = float(np.percentile(ms, 50))
+                        entry[name+'_p99_ms'] = float(np.percentile(ms, 99))
+                streams[streamId] = entry
+        return {'uptime_s': time.time() - self.started, 'streams': streams}
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+
+def decodeFrame(body, headers):
+    """RGB frame from a request body.  Either an encoded image (JPEG, PNG, ...), or raw
+        RGB bytes with an 'X-Frame-Shape: height,width' header.
+    """
+    data = np.frombuffer(body, np.uint8)
+    shape = headers.get('X-Frame-Shape')
+    if shape:
+        try:
+            height, width = [int(v) for v in shape.split(',')]
+        except ValueError:
+            return None
+        if height <= 0 or width <= 0 or data.size != height*width*3:
+            return None
+        return data.reshape(height, width, 3)
+    bgr = cv2.imdecode(data, cv2.IMREAD_COLOR)
+    if bgr is None:
+        return None
+    return cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB)
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    """POST /streams/<id>/frames   one frame, answers with its fits and measurements
+       DELETE /streams/<id>        forget a stream's tracking state
+       GET /metrics                per-stream frame counts and latency percentiles
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def streamId(self):
+        parts = self.path.strip('/').split('/')
+        if len(parts) >= 2 and parts[0] == 'streams' and parts[1]:
+            return parts[1], parts[2:]
+        return None, parts
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        streamId, rest = self.streamId()
+        if streamId is None or rest != ['frames']:
+            return self.reply(404, {'error': 'unknown path %s' %self.path})
+        image = decodeFrame(body, self.headers)
+        if image is None:
+            return self.reply(400, {'error': 'could not decode frame'})
+        future = self.server.service.submit(streamId, image)
+        if future is None:
+            return self.reply(503, {'error': 'stream %s is busy' %streamId}, {'Retry-After': '0'})
+        try:
+            result = future.result()
+        except Exception as e:
+            return self.reply(500, {'error': repr(e)})
+        self.reply(200, result)
+
+    def do_DELETE(self):
+        streamId, rest = self.streamId()
+        if streamId is None or rest or not self.server.service.removeStream(streamId):
+            return self.reply(404, {'error': 'unknown stream'})
+        self.reply(200, {'removed': streamId})
+
+    def do_GET(self):
+        if self.path.rstrip('/') != '/metrics':
+            return self.reply(404, {'error': 'unknown path %s' %self.path})
+        self.reply(200, self.server.service.metrics())
+
+    def reply(self, code, payload, headers={}):
+        data = json.dumps(payload).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+def serve(host='127.0.0.1', port=8008, workers=4, maxPending=2, verbose=False, fusedWarp=False):
+    service = LaneService(workers, maxPending, fusedWarp=fusedWarp)
+    server = ThreadingHTTPServer((host, port), ServiceHandler)
+    server.daemon_threads = True
+    server.service = service
+    server.verbose = verbose
+    print("Lane service on http://{}:{} with {} workers".format(host, port, workers))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Multi-stream lane finding service')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on, local only by default')
+    parser.add_argument('--port', type=int, default=8008)
+    parser.add_argument('--workers', type=int, default=4, help='pipeline threads shared by all streams')
+    parser.add_argument('--max-pending', type=int, default=2, help='frames a stream may have waiting before it gets 503')
+    parser.add_argument('--fused-warp', action='store_true', help='un-distort and warp in one remap, as main.py --fused-warp')
+    parser.add_argument('--verbose', action='store_true', help='log every request')
+    args = parser.parse_args()
+    serve(args.host, args.port, args.workers, args.max_pending, args.verbose, args.fused_warp)
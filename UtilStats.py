@@ -0,0 +1,147 @@
+import json
+import time
+
+class _NullStage:
+    """Shared do-nothing context manager handed out while stats are disabled"""
+    def __enter__(self):
+        return self
+    def __exit__(self, *args):
+        return False
+
+_NULL_STAGE = _NullStage()
+
+class _Stage:
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name  = name
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+    def __exit__(self, *args):
+        self.stats.addTime(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class Stats:
+    """Low overhead stage timers and event counters for a run.  While disabled each call 
+        is one flag check, so the hooks can stay in the pipeline permanently.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.trace   = None
+        self.samples = None
+        self.kept    = None
+        self.reset()
+    
+    def reset(self):
+        self.frames     = 0
+        self.stageTime  = {}
+        self.stageCount = {}
+        self.counters   = {}
+        self.frame      = {}
+    
+    def enable(self, traceName=None, samples=False, keepFrames=False):
+        """Start collecting.  If 'traceName' is given, one JSON line per frame is written to it.
+            With 'samples' every stage call is kept for latency percentiles, see latency().
+            With 'keepFrames' the per-frame stats are kept for collected() instead.
+        """
+        self.reset()
+        self.enabled = True
+        self.samples = {} if samples else None
+        self.kept    = [] if keepFrames else None
+        if traceName:
+            self.trace = open(traceName, 'w')
+    
+    def disable(self):
+        self.enabled = False
+        if self.trace:
+            self.trace.close()
+            self.trace = None
+    
+    def detach(self):
+        """Stop collecting in a forked worker process.  The trace file copied from the 
+            parent is held on to unclosed, so its buffered lines are not written twice.
+        """
+        self.enabled = False
+        if self.trace:
+            self.parentTrace, self.trace = self.trace, None
+    
+    def stage(self, name):
+        """Context manager that times a pipeline stage"""
+        if not self.enabled:
+            return _NULL_STAGE
+        return _Stage(self, name)
+    
+    def addTime(self, name, seconds):
+        self.stageTime[name]  = self.stageTime.get(name, 0.0) + seconds
+        self.stageCount[name] = self.stageCount.get(name, 0) + 1
+        if self.samples is not None:
+            self.samples.setdefault(name, []).append(seconds)
+        key = name+'_ms'
+        self.frame[key] = self.frame.get(key, 0.0) + seconds*1000
+    
+    def count(self, name, n=1):
+        """Add 'n' to an event counter (for the run and for the current frame)"""
+        if not self.enabled:
+            return
+        self.counters[name] = self.counters.get(name, 0) + n
+        self.frame[name]    = self.frame.get(name, 0) + n
+    
+    def endFrame(self):
+        if not self.enabled:
+            return
+        if self.trace or self.kept is not None:
+            self.frame['frame'] = self.frames
+        if self.trace:
+            self.trace.write(json.dumps(self.frame) + '\n')
+        if self.kept is not None:
+            self.kept.append(self.frame)
+        self.frames += 1
+        self.frame = {}
+    
+    def summary(self):
+        stages = {}
+        for name, total in self.stageTime.items():
+            stages[name] = {'calls': self.stageCount[name], 'total_s': total, 
+                            'ms_per_frame': total*1000/max(self.frames, 1)}
+        return {'frames': self.frames, 'stages': stages, 'counters': dict(self.counters)}
+    
+    def collected(self):
+        """Everything collected so far, for merge() in the parent of a worker process"""
+        return {'frames': self.frames, 'stageTime': dict(self.stageTime), 'stageCount': dict(self.stageCount),
+                'counters': dict(self.counters), 'kept': list(self.kept or [])}
+    
+    def merge(self, collected):
+        """Add what a worker collected, its frames are numbered on from the ones so far"""
+        if not self.enabled:
+            return
+        for name, seconds in collected['stageTime'].items():
+            self.stageTime[name]  = self.stageTime.get(name, 0.0) + seconds
+            self.stageCount[name] = self.stageCount.get(name, 0) + collected['stageCount'][name]
+        for name, n in collected['counters'].items():
+            self.counters[name] = self.counters.get(name, 0) + n
+        if self.trace:
+            for frame in collected['kept']:
+                self.trace.write(json.dumps(dict(frame, frame=self.frames + frame['frame'])) + '\n')
+        self.frames += collected['frames']
+    
+    def latency(self):
+        """Per stage call count, mean, p50 and p99 in ms, from the kept samples"""
+        import numpy as np
+        stages = {}
+        for name, samples in (self.samples or {}).items():
+            ms = np.array(samples)*1000
+            stages[name] = {'count': len(ms), 'mean_ms': float(ms.mean()), 
+                            'p50_ms': float(np.percentile(ms, 50)), 'p99_ms': float(np.percentile(ms, 99))}
+        return stages
+    
+    def report(self):
+        summary = self.summary()
+        print("Stats for {} frames".format(summary['frames']))
+        for name, stage in sorted(summary['stages'].items(), key=lambda item: -item[1]['total_s']):
+            print("    {:14s} {:8.2f} ms/frame  ({} calls)".format(name, stage['ms_per_frame'], stage['calls']))
+        for name, value in sorted(summary['counters'].items()):
+            print("    {:14s} {}".format(name, value))
+
+# the one instance used by the pipeline
+stats = Stats()
@@ -0,0 +1,239 @@
+import os
+import csv
+import json
+import time
+import hashlib
+import argparse
+import itertools
+import multiprocessing
+import numpy as np
+import cv2
+
+import UtilMask
+import UtilImage
+import UtilLines
+
+# bump when the planes saved in the cache change
+CACHE_VERSION = 2
+
+class SweepPlanes:
+    """One birds-eye image and its threshold independent planes: absolute Sobel gradients,
+        squared magnitude and HLS.  Every threshold setting is evaluated from these, and
+        they can be saved to and loaded from an .npz file.  'frameMask' is a FrameMask of
+        the image seeded with the planes, for the lane search.
+    """
+    def __init__(self, topDown, abs_sobelx, abs_sobely, hls):
+        self.topDown    = topDown
+        self.abs_sobelx = abs_sobelx
+        self.abs_sobely = abs_sobely
+        self.hls        = hls
+        self.mag2       = np.square(abs_sobelx, dtype=np.int32)
+        self.mag2      += np.square(abs_sobely, dtype=np.int32)
+        self.masks      = {}
+        self.frameMask  = UtilMask.FrameMask(topDown)
+        self.frameMask.seedPlanes((abs_sobelx, abs_sobely), hls)
+
+        # (hue, lightness) histogram of the saturated pixels, as 2D prefix sums, so the
+        # color mask pixel count of any (h_thresh, l_thresh) is a few lookups
+        hue, light, sat = cv2.split(hls)
+        saturated = sat >= UtilMask.YELLOW_S
+        hist = np.bincount(hue[saturated].astype(np.int32)*256 + light[saturated], minlength=256*256).reshape(256, 256)
+        self.hlSum = np.zeros((257, 257), np.int64)
+        self.hlSum[1:, 1:] = hist.cumsum(0).cumsum(1)
+        # lit pixels per lightness value, as suffix sums
+        lightHist = np.bincount(light.ravel(), minlength=256)
+        self.lightAbove = np.concatenate([np.cumsum(lightHist[::-1])[::-1], [0]])
+
+    @classmethod
+    def fromImage(cls, topDown, ksize=5):
+        topDown = topDown.copy()
+        frameMask = UtilMask.FrameMask(topDown, ksize)
+        abs_sobelx, abs_sobely = frameMask.sobel()
+        return cls(topDown, abs_sobelx, abs_sobely, frameMask.hls())
+
+    @classmethod
+    def load(cls, fileName):
+        with np.load(fileName) as data:
+            return cls(data['topDown'], data['abs_sobelx'], data['abs_sobely'], data['hls'])
+
+    def save(self, fileName):
+        np.savez_compressed(fileName, topDown=self.topDown, abs_sobelx=self.abs_sobelx, abs_sobely=self.abs_sobely, hls=self.hls)
+
+    def mask(self, kind, thresh):
+        """One gradient threshold mask, each (kind, threshold) is computed once per image"""
+        key = (kind, thresh)
+        if key not in self.masks:
+            if kind == 'abs':
+                self.masks[key] = UtilMask.absThreshMask(self.abs_sobelx, self.abs_sobely, thresh)
+            elif kind == 'mag':
+                self.masks[key] = UtilMask.magThreshMask(self.mag2, thresh)
+            elif kind == 'dir':
+                self.masks[key] = UtilMask.dirThreshMask(self.abs_sobelx, self.abs_sobely, thresh)
+        return self.masks[key]
+
+    def gradientPixels(self, abs_thresh, mag_thresh, dir_thresh):
+        """Lit pixels of FrameMask.gradientMask()"""
+        magDir = cv2.bitwise_and(self.mask('mag', mag_thresh), self.mask('dir', dir_thresh))
+        return cv2.countNonZero(cv2.bitwise_or(self.mask('abs', abs_thresh), magDir, dst=magDir))
+
+    def hlCount(self, h_thresh, l_range):
+        """Saturated pixels with hue in h_thresh and lightness in l_range, both inclusive"""
+        h0, h1 = int(h_thresh[0]), int(h_thresh[1])
+        l0, l1 = int(l_range[0]), int(l_range[1])
+        if h1 < h0 or l1 < l0:
+            return 0
+        s = self.hlSum
+        return int(s[h1+1, l1+1] - s[h0, l1+1] - s[h1+1, l0] + s[h0, l0])
+
+    def colorPixels(self, h_thresh, l_thresh):
+        """Lit pixels of FrameMask.colorMask() without building it: yellow + light - both"""
+        lightLo = int(np.floor(l_thresh)) + 1
+        yellow = self.hlCount(h_thresh, UtilMask.YELLOW_L)
+        both   = self.hlCount(h_thresh, (max(UtilMask.YELLOW_L[0], lightLo), UtilMask.YELLOW_L[1]))
+        light  = int(self.lightAbove[min(max(lightLo, 0), 256)])
+        return yellow + light - both
+
+
+def cacheName(cacheDir, fileName, fusedWarp):
+    """Planes file for an image, named by its path, size, modification time and warp"""
+    info = os.stat(fileName)
+    key = '{}:{}:{}:{}:{}'.format(CACHE_VERSION, os.path.abspath(fileName), info.st_size, info.st_mtime_ns, fusedWarp)
+    return os.path.join(cacheDir, hashlib.sha1(key.encode()).hexdigest() + '.npz')
+
+def loadPlanes(fileName, cacheDir=None):
+    """Planes of an image's birds-eye view, from the cache if they are there"""
+    import main
+    if cacheDir:
+        planesName = cacheName(cacheDir, fileName, main.FUSED_WARP)
+        if os.path.isfile(planesName):
+            return SweepPlanes.load(planesName)
+    image = UtilImage.imread(fileName)
+    planes = SweepPlanes.fromImage(main.birdsEye(image))
+    if cacheDir:
+        os.makedirs(cacheDir, exist_ok=True)
+        planes.save(planesName)
+    return planes
+
+def fitResult(planes, h_thresh, l_thresh):
+    """Lane search and fit exactly as the pipeline runs them on a still, including its
+        pixel count gates and the lower l_thresh retry
+    """
+    lanes = UtilLines.LaneLines(hThresh=h_thresh, lThresh=l_thresh)
+    lanes.processFrame(planes.topDown, frameMask=planes.frameMask, draw=False)
+    result = {'lanePixels': int(lanes.lft_lane_inds.size + lanes.rgt_lane_inds.size), 'detected': bool(lanes.detected)}
+    if lanes.detected:
+        result.update({'laneWidth': float(lanes.laneWidth), 'curveRadKm': float(lanes.curveRadKm)})
+    return result
+
+def sweepImage(task):
+    """Evaluate every threshold setting on one image.  The gradient thresholds only change
+        the gradient mask, so the search and fit run once per (h_thresh, l_thresh).
+    """
+    fileName, grid, cacheDir = task
+    start = time.perf_counter()
+    planes = loadPlanes(fileName, cacheDir)
+
+    gradient = {}
+    for abs_thresh, mag_thresh, dir_thresh in itertools.product(grid['abs'], grid['mag'], grid['dir']):
+        gradient[(abs_thresh, mag_thresh, dir_thresh)] = planes.gradientPixels(abs_thresh, mag_thresh, dir_thresh)
+    color = {}
+    for h_thresh, l_thresh in itertools.product(grid['h'], grid['l']):
+        result = fitResult(planes, h_thresh, l_thresh)
+        result['colorPixels'] = planes.colorPixels(h_thresh, l_thresh)
+        color[(h_thresh, l_thresh)] = result
+
+    rows = []
+    for (abs_thresh, mag_thresh, dir_thresh), gradientPixels in gradient.items():
+        for (h_thresh, l_thresh), result in color.items():
+            row = {'file': fileName, 'abs_thresh': abs_thresh, 'mag_thresh': mag_thresh, 'dir_thresh': dir_thresh,
+                   'h_thresh': h_thresh, 'l_thresh': l_thresh, 'gradientPixels': gradientPixels}
+            row.update(result)
+            rows.append(row)
+    return rows, time.perf_counter() - start
+
+def runSweep(fileNames, grid, workers=0, cacheDir=None):
+    """All rows for all images, in file order.  Planes use main's warp setting."""
+    import main
+    import UtilParallel
+    tasks = [(fileName, grid, cacheDir) for fileName in fileNames]
+    if workers <= 0:
+        results = [sweepImage(task) for task in tasks]
+    else:
+        with multiprocessing.Pool(workers, initializer=UtilParallel.initWorker, initargs=(main.pipelineSettings(),)) as pool:
+            results = pool.map(sweepImage, tasks, chunksize=1)
+    rows = [row for imageRows, seconds in results for row in imageRows]
+    return rows, sum(seconds for imageRows, seconds in results)
+
+SETTING_KEYS = ('abs_thresh', 'mag_thresh', 'dir_thresh', 'h_thresh', 'l_thresh')
+
+def summarize(rows):
+    """Per setting totals over all images, most detections first"""
+    settings = {}
+    for row in rows:
+        key = tuple(row[name] for name in SETTING_KEYS)
+        entry = settings.setdefault(key, {'images': 0, 'detected': 0, 'gradientPixels': 0, 'colorPixels': 0, 'lanePixels': 0})
+        entry['images'] += 1
+        entry['detected'] += row['detected']
+        for name in ('gradientPixels', 'colorPixels', 'lanePixels'):
+            entry[name] += row[name]
+
+    summary = []
+    for key, entry in settings.items():
+        images = entry['images']
+        item = dict(zip(SETTING_KEYS, key))
+        item.update({'images': images, 'detectionRate': entry['detected']/images,
+                     'meanGradientPixels': entry['gradientPixels']/images,
+                     'meanColorPixels': entry['colorPixels']/images,
+                     'meanLanePixels': entry['lanePixels']/images})
+        summary.append(item)
+    summary.sort(key=lambda item: (-item['detectionRate'], -item['meanLanePixels']))
+    return summary
+
+def writeRows(rows, fileName):
+    names = ['file'] + list(SETTING_KEYS) + ['gradientPixels', 'colorPixels', 'lanePixels', 'detected', 'laneWidth', 'curveRadKm']
+    with open(fileName, 'w', newline='') as f:
+        writer = csv.DictWriter(f, names)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow({name: ' '.join(str(v) for v in value) if isinstance(value, tuple) else value
+                             for name, value in row.items()})
+
+def parsePairs(values):
+    return [tuple(float(v) for v in value.split(',')) for value in values]
+
+if __name__ == '__main__':
+    import main
+    parser = argparse.ArgumentParser(description='Sweep mask thresholds over a set of stills')
+    parser.add_argument('images', nargs='+', help='folders or glob patterns of stills')
+    parser.add_argument('--abs', nargs='+', default=['50,200'], metavar='LO,HI', help='abs_thresh values')
+    parser.add_argument('--mag', nargs='+', default=['80,200'], metavar='LO,HI', help='mag_thresh values')
+    parser.add_argument('--dir', nargs='+', default=['0.7,1.3'], metavar='LO,HI', help='dir_thresh values')
+    parser.add_argument('--h', nargs='+', default=['15,30'], metavar='LO,HI', help='h_thresh values')
+    parser.add_argument('--l', nargs='+', type=float, default=[210], help='l_thresh values')
+    parser.add_argument('--fused-warp', action='store_true', help='birds-eye view as main.py --fused-warp makes it')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='process pool size, 0 is serial')
+    parser.add_argument('--cache', default='sweep_cache', help='folder for cached planes, empty to keep them in memory only')
+    parser.add_argument('--csv', default='sweep.csv', help='one row per image and setting')
+    parser.add_argument('--json', default='sweep.json', help='per setting summary')
+    args = parser.parse_args()
+
+    main.FUSED_WARP = args.fused_warp
+    grid = {'abs': parsePairs(args.abs), 'mag': parsePairs(args.mag), 'dir': parsePairs(args.dir),
+            'h': parsePairs(args.h), 'l': args.l}
+    fileNames = main.collectImages(args.images)
+    if not fileNames:
+        raise Exception("Error, no images found for %s" %' '.join(args.images))
+
+    start = time.perf_counter()
+    rows, cpuSeconds = runSweep(fileNames, grid, args.workers, args.cache or None)
+    elapsed = time.perf_counter() - start
+    summary = summarize(rows)
+    writeRows(rows, args.csv)
+    with open(args.json, 'w') as f:
+        json.dump({'images': len(fileNames), 'settings': len(summary), 'total_s': elapsed, 'settings_by_rate': summary}, f, indent=1)
+
+    print("Swept {} settings over {} images in {:.1f} s ({:.1f} s of work)".format(len(summary), len(fileNames), elapsed, cpuSeconds))
+    for item in summary[:5]:
+        print("    detected {:5.1%}  lane px {:8.0f}  h {} l {} abs {} mag {} dir {}".format(
+            item['detectionRate'], item['meanLanePixels'], item['h_thresh'], item['l_thresh'],
+            item['abs_thresh'], item['mag_thresh'], item['dir_thresh']))
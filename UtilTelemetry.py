@@ -0,0 +1,89 @@
+import os
+import numpy as np
+
+# one entry per frame, (name, dtype, width)
+COLUMNS = [('frame',      np.int64,   1),
+           ('detected',   np.bool_,   1),
+           ('lft_fit',    np.float64, 3),
+           ('rgt_fit',    np.float64, 3),
+           ('curveRadKm', np.float64, 1),
+           ('laneOffset', np.float64, 1),
+           ('laneWidth',  np.float64, 1)]
+
+class TelemetryWriter:
+    """Collect the per-frame lane numbers in fixed-size column arrays and append them to a
+        file one chunk at a time.
+        
+        format 'npy' : each chunk is one .npy array per column, written back to back, so 
+                       the file can be appended to and read with readTelemetry()
+        format 'csv' : one text row per frame with a header, fits split into _a, _b, _c
+    """
+    def __init__(self, fileName, format='npy', chunkSize=1024, append=False):
+        self.fileName  = fileName
+        self.format    = format
+        self.chunkSize = chunkSize
+        self.columns   = {name: np.zeros((chunkSize, width) if width > 1 else chunkSize, dtype) 
+                          for name, dtype, width in COLUMNS}
+        self.used      = 0
+        
+        exists = append and os.path.isfile(fileName)
+        if format == 'npy':
+            self.file = open(fileName, 'ab' if exists else 'wb')
+        else:
+            self.file = open(fileName, 'a' if exists else 'w')
+            if not exists:
+                self.file.write(','.join(csvHeader()) + '\n')
+    
+    def add(self, frame, laneLines):
+        """Record the current state of 'laneLines' as frame number 'frame'"""
+        row = self.used
+        nan3 = (np.nan, np.nan, np.nan)
+        self.columns['frame'][row]      = frame
+        self.columns['detected'][row]   = laneLines.detected
+        self.columns['lft_fit'][row]    = getattr(laneLines, 'lft_fit', nan3)
+        self.columns['rgt_fit'][row]    = getattr(laneLines, 'rgt_fit', nan3)
+        self.columns['curveRadKm'][row] = getattr(laneLines, 'curveRadKm', np.nan)
+        self.columns['laneOffset'][row] = getattr(laneLines, 'laneOffset', np.nan)
+        self.columns['laneWidth'][row]  = getattr(laneLines, 'laneWidth', np.nan)
+        self.used += 1
+        if self.used == self.chunkSize:
+            self.flush()
+    
+    def flush(self):
+        if self.used == 0:
+            return
+        if self.format == 'npy':
+            for name, dtype, width in COLUMNS:
+                np.save(self.file, self.columns[name][:self.used])
+        else:
+            table = np.column_stack([self.columns[name][:self.used].astype(np.float64) for name, dtype, width in COLUMNS])
+            fmt = ['%d', '%d'] + ['%.10g']*(table.shape[1] - 2)
+            np.savetxt(self.file, table, fmt=fmt, delimiter=',')
+        self.file.flush()
+        self.used = 0
+    
+    def close(self):
+        self.flush()
+        self.file.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *args):
+        self.close()
+
+def csvHeader():
+    names = []
+    for name, dtype, width in COLUMNS:
+        names += [name] if width == 1 else [name+'_'+c for c in 'abc'[:width]]
+    return names
+
+def readTelemetry(fileName):
+    """All chunks of an 'npy' telemetry file as {column name: array}"""
+    chunks = {name: [] for name, dtype, width in COLUMNS}
+    size = os.path.getsize(fileName)
+    with open(fileName, 'rb') as f:
+        while f.tell() < size:
+            for name, dtype, width in COLUMNS:
+                chunks[name].append(np.load(f))
+    return {name: np.concatenate(parts) if parts else np.zeros(0) for name, parts in chunks.items()}
@@ -0,0 +1,168 @@
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import subprocess
+import numpy as np
+import cv2
+
+class FrameReader:
+    """Decode a movie on a background thread into a reusable ring of RGB frame buffers,
+        so decoding overlaps with the pipeline.  'start' and 'count' limit it to a range 
+        of frames.
+    """
+    def __init__(self, fileName, ringSize=8, start=0, count=None):
+        self.capture = cv2.VideoCapture(fileName)
+        if not self.capture.isOpened():
+            raise Exception("Error, could not open movie %s" %fileName)
+        self.width      = int(self.capture.get(cv2.CAP_PROP_FRAME_WIDTH))
+        self.height     = int(self.capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        self.fps        = self.capture.get(cv2.CAP_PROP_FPS)
+        self.frameCount = int(self.capture.get(cv2.CAP_PROP_FRAME_COUNT))
+        self.size       = (self.width, self.height)
+        self.remaining  = count
+        if start > 0:
+            self.capture.set(cv2.CAP_PROP_POS_FRAMES, start)
+        
+        # decode into one BGR buffer, then convert into a free RGB ring slot
+        self.bgr  = np.empty((self.height, self.width, 3), np.uint8)
+        self.ring = [np.empty((self.height, self.width, 3), np.uint8) for i in range(ringSize)]
+        self.free = queue.Queue()
+        self.full = queue.Queue()
+        for idx in range(ringSize):
+            self.free.put(idx)
+        
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+    
+    def run(self):
+        while True:
+            idx = self.free.get()
+            if idx is None or self.remaining == 0:
+                break
+            if self.remaining is not None:
+                self.remaining -= 1
+            ok, _ = self.capture.read(self.bgr)
+            if not ok:
+                break
+            cv2.cvtColor(self.bgr, cv2.COLOR_BGR2RGB, dst=self.ring[idx])
+            self.full.put(idx)
+        self.full.put(None)
+    
+    def frames(self):
+        """Yield frames in order.  Each buffer is reused once the next frame is requested,
+            so copy it if it must outlive the loop iteration.
+        """
+        last = None
+        try:
+            while True:
+                idx = self.full.get()
+                if last is not None:
+                    self.free.put(last)
+                if idx is None:
+                    break
+                last = idx
+                yield self.ring[idx]
+        finally:
+            self.close()
+    
+    def close(self):
+        if self.thread.is_alive():
+            self.free.put(None)
+            # drain so a reader blocked on a full ring can see the stop
+            while self.thread.is_alive():
+                try:
+                    idx = self.full.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                if idx is not None:
+                    self.free.put(idx)
+            self.thread.join()
+        self.capture.release()
+
+
+class FrameWriter:
+    """Encode RGB frames on a background thread.  write() converts each frame into a ring
+        buffer, so the caller can reuse its image as soon as write() returns.
+    """
+    def __init__(self, fileName, size, fps, ringSize=8, fourcc='mp4v'):
+        width, height = size
+        self.writer = cv2.VideoWriter(fileName, cv2.VideoWriter_fourcc(*fourcc), fps, (width, height))
+        if not self.writer.isOpened():
+            raise Exception("Error, could not open %s for writing" %fileName)
+        
+        self.ring = [np.empty((height, width, 3), np.uint8) for i in range(ringSize)]
+        self.free = queue.Queue()
+        self.full = queue.Queue()
+        for idx in range(ringSize):
+            self.free.put(idx)
+        
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+    
+    def run(self):
+        while True:
+            idx = self.full.get()
+            if idx is None:
+                break
+            self.writer.write(self.ring[idx])
+            self.free.put(idx)
+    
+    def write(self, image):
+        idx = self.free.get()
+        cv2.cvtColor(image, cv2.COLOR_RGB2BGR, dst=self.ring[idx])
+        self.full.put(idx)
+    
+    def close(self):
+        if self.thread.is_alive():
+            self.full.put(None)
+            self.thread.join()
+        self.writer.release()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *args):
+        self.close()
+
+
+def probeMovie(fileName):
+    """(size, fps, frameCount) of a movie without decoding it"""
+    capture = cv2.VideoCapture(fileName)
+    if not capture.isOpened():
+        raise Exception("Error, could not open movie %s" %fileName)
+    size = (int(capture.get(cv2.CAP_PROP_FRAME_WIDTH)), int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+    fps = capture.get(cv2.CAP_PROP_FPS)
+    frameCount = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+    capture.release()
+    return size, fps, frameCount
+
+def concatMovies(fileNames, outName, fps):
+    """Join movies that share a codec and size.  ffmpeg's concat demuxer copies the 
+        streams without re-encoding, without ffmpeg (or if it fails) the frames are decoded
+        and encoded again.  Returns True if the streams were copied.
+    """
+    ffmpeg = shutil.which('ffmpeg')
+    if ffmpeg:
+        with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as listFile:
+            for fileName in fileNames:
+                listFile.write("file '%s'\n" %os.path.abspath(fileName).replace("'", "'\\''"))
+        try:
+            result = subprocess.run([ffmpeg, '-y', '-loglevel', 'error', '-f', 'concat', '-safe', '0', 
+                                     '-i', listFile.name, '-c', 'copy', outName])
+        finally:
+            os.remove(listFile.name)
+        if result.returncode == 0:
+            return True
+    
+    writer = None
+    for fileName in fileNames:
+        reader = FrameReader(fileName)
+        if writer is None:
+            writer = FrameWriter(outName, reader.size, fps)
+        for frame in reader.frames():
+            writer.write(frame)
+    if writer is not None:
+        writer.close()
+    return False
@@ -1,64 +1,146 @@
 import os
 import numpy as np
-import cv2
 import glob
-import matplotlib.pyplot as plt
-import matplotlib.image as mpimg
+import json
+import time
 
 import UtilCamera
 import UtilMask
 import UtilLines
+import UtilBuffers
+import UtilImage
+from UtilStats import stats
+from UtilDebug import debug
 
+# the calibration and remap tables are loaded by the first frame, and video, pool and
+# telemetry modules are imported by the functions that use them, so short jobs start fast
 camera      = UtilCamera.Camera()
 perspective = UtilMask.Perspective()
 laneLines   = UtilLines.LaneLines()
+# frame sized outputs of the stateless stages, reused every frame
+buffers     = UtilBuffers.BufferPool()
+
+# go straight from the raw frame to the birds-eye view with one cached remap table 
+# (--fused-warp).  Off by default: interpolating once instead of twice moves the lane 
+# pixels slightly, which changes fits and curvature on some frames.
+FUSED_WARP  = False
+
+def pipelineSettings():
+    """Command line options that worker processes need to match this process"""
+    return {'fusedWarp': FUSED_WARP, 'coarseScale': UtilLines.LaneLines.coarseScale, 
+            'adaptive': UtilLines.LaneLines.adaptive}
+
+def applySettings(settings):
+    global FUSED_WARP
+    FUSED_WARP = settings['fusedWarp']
+    UtilLines.LaneLines.coarseScale = settings['coarseScale']
+    UtilLines.LaneLines.adaptive    = settings['adaptive']
 
 def imagePipeline(image, fileName=None):
     """Complete process for each frame image.  If 'fileName' is given then each stage
         of the pipeline will write out an image for debugging.
+        The returned image lives in the 'buffers' pool and is overwritten by the next 
+        frame, so copy() it to keep it.
     """
     if fileName:
-        mpimg.imsave(os.path.join("test_images/outputs/", fileName), image)
+        debug.save(fileName, "", image)
     
-    # use camera to un-distort raw frames
-    imgUD = camera.undistort(image)
+    if not fileName and not laneLines.needsDetection():
+        # adaptive mode and the lanes are stable, reuse the predicted fit for this frame
+        with stats.stage('undistort'):
+            imgUD = camera.undistort(image, buffers.get('imgUD', image.shape))
+        return finishFrame(imgUD, None, None)
+    
+    imgUD, topDown, frameMask = prepareFrame(image)
     if fileName:
-        mpimg.imsave(os.path.join("test_images/outputs/", fileName+"-0-udist.jpg"), imgUD)
+        # the lane fill is drawn into imgUD later, so the writer gets its own copy
+        debug.save(fileName, "-0-udist.jpg", imgUD.copy())
     
-    # generate mask from gradients/colors
-    imgMasked = UtilMask.maskPipeline(image)
+    # generate mask from gradients/colors, only used for debug output
     if fileName:
-        mpimg.imsave(os.path.join("test_images/outputs/", fileName+"-1-mask.jpg"), imgMasked)
+        with stats.stage('maskPipeline'):
+            imgMasked = UtilMask.FrameMask(image).mask()
+        debug.save(fileName, "-1-mask.jpg", imgMasked)
     
-    # change to birds-eye view
-    topDown = perspective.topDown(imgUD)
     if fileName:
-        mpimg.imsave(os.path.join("test_images/outputs/", fileName+"-2-topdwn.jpg"), topDown)
+        debug.save(fileName, "-2-topdwn.jpg", topDown.copy())
     
     # output test of perspective to make sure lines are parallel
     if fileName:
         withLines, topDownWithLines = perspective.testTransform(imgUD)
-        mpimg.imsave(os.path.join("test_images/outputs/", fileName+"-2a-topdwn2.jpg"), withLines)
-        mpimg.imsave(os.path.join("test_images/outputs/", fileName+"-2b-topdwn3.jpg"), topDownWithLines)
+        debug.save(fileName, "-2a-topdwn2.jpg", withLines)
+        debug.save(fileName, "-2b-topdwn3.jpg", topDownWithLines)
+    
+    return finishFrame(imgUD, topDown, frameMask, fileName)
+
+def prepareFrame(image):
+    """Stateless first half of the pipeline, safe to run on a worker process.
+        Returns the un-distorted image, the birds-eye view, and its lazy mask.  These
+        live in the 'buffers' pool and are overwritten by the next frame.
+    """
+    # use camera to un-distort raw frames
+    with stats.stage('undistort'):
+        imgUD = camera.undistort(image, buffers.get('imgUD', image.shape))
+    
+    # change to birds-eye view
+    with stats.stage('topDown'):
+        topDown = birdsEye(image, imgUD)
     
+    return imgUD, topDown, UtilMask.FrameMask(topDown, pool=buffers)
+
+def birdsEye(image, imgUD=None):
+    """Birds-eye view of a raw frame.  With FUSED_WARP this is one remap of the raw frame,
+        otherwise the un-distorted frame 'imgUD' (made here if not given) is warped.
+        The result lives in the 'buffers' pool, like imgUD.
+    """
+    if FUSED_WARP:
+        return camera.topDown(image, perspective, buffers.get('topDown', image.shape))
+    if imgUD is None:
+        imgUD = camera.undistort(image, buffers.get('imgUD', image.shape))
+    return perspective.topDown(imgUD, buffers.get('topDown', image.shape))
+
+def warmUp(size):
+    """Set up the perspective and build the remap tables for (width, height) frames, so 
+        worker processes started afterwards find them ready instead of all building and
+        saving their own
+    """
+    if not perspective.isSetup:
+        perspective.calcTransform(np.zeros((size[1], size[0], 3), np.uint8))
+    camera.getUndistortMaps(size)
+    if FUSED_WARP:
+        camera.getWarpMaps(perspective.warpMat, perspective.shape)
+
+def finishFrame(imgUD, topDown, frameMask, fileName=None):
+    """Stateful second half of the pipeline, frames must be given in order.  A 'topDown'
+        of None means this frame skips detection and coasts on the predicted lanes.
+        The lane fill is drawn into 'imgUD' and that same array is returned, so it is 
+        only valid until the next frame if it came from the 'buffers' pool.
+    """
     # lane pipeline
-    searched  = laneLines.processFrame(topDown, fileName)
+    if topDown is None:
+        laneLines.coast()
+        stats.count('coasted')
+    else:
+        with stats.stage('processFrame'):
+            searched  = laneLines.processFrame(topDown, fileName, frameMask)
     if fileName:
-        mpimg.imsave(os.path.join("test_images/outputs/", fileName+"-4-search.jpg"), searched)
-    
-    # get the green safe region
-    laneFill = laneLines.getLaneFill(perspective)    
+        debug.save(fileName, "-4-search.jpg", searched.copy())
     
-    # combine for final result
-    imgFinal = UtilMask.weighted_img(laneFill, imgUD, α=0.8, β=0.3)
+    # blend the green safe region straight into the un-distorted frame for the final result
+    with stats.stage('laneFill'):
+        imgFinal = laneLines.drawLaneFill(imgUD, perspective, α=0.8, β=0.3)
     if fileName:
-        mpimg.imsave(os.path.join("test_images/outputs/", fileName+"-5-final.jpg"), imgFinal)
+        # addLaneInfo() draws on imgFinal, so the writer gets its own copy
+        debug.save(fileName, "-5-final.jpg", imgFinal.copy())
     
     # also add a test overlay for curvature and car location
-    laneLines.addLaneInfo(imgFinal)
+    with stats.stage('addLaneInfo'):
+        laneLines.addLaneInfo(imgFinal)
     if fileName:
-        mpimg.imsave(os.path.join("test_images/outputs/", fileName+"-6-annot.jpg"), imgFinal)
-        
+        debug.save(fileName, "-6-annot.jpg", imgFinal.copy())
+        debug.endFrame(fileName)
+    
+    stats.endFrame()
     return imgFinal
     
 
@@ -81,25 +163,237 @@ def processImages():
             continue
         print("Processing: ", fileName)
         fullName = os.path.join("test_images",fileName)
-        image = mpimg.imread(fullName)
+        image = UtilImage.imread(fullName)
         laneLines = UtilLines.LaneLines() # reset lane lines for test images
         imagePipeline(image, fileName)
+    debug.close()
         
-from moviepy.editor import VideoFileClip
+def telemetryFrame(image):
+    """Headless pipeline: update the lane fits and measurements without drawing anything.
+        With FUSED_WARP the raw frame goes straight to the birds-eye view, and no 
+        un-distorted frame is made.
+    """
+    if not laneLines.needsDetection():
+        laneLines.coast()
+        stats.count('coasted')
+    else:
+        with stats.stage('topDown'):
+            topDown = birdsEye(image)
+        with stats.stage('processFrame'):
+            laneLines.processFrame(topDown, frameMask=UtilMask.FrameMask(topDown, pool=buffers), draw=False)
+    stats.endFrame()
+
+def processTelemetry(movieName, outName, format='npy'):
+    """Run the headless pipeline over a movie and stream each frame's fits, curvature, 
+        offset and lane width to a columnar file.  Nothing is rendered or encoded.
+    """
+    import UtilVideo
+    import UtilTelemetry
+    reader = UtilVideo.FrameReader(movieName)
+    with UtilTelemetry.TelemetryWriter(outName, format) as telemetry:
+        for idx, frame in enumerate(reader.frames()):
+            telemetryFrame(frame)
+            telemetry.add(idx, laneLines)
 
-def processMovie(movieName):
-    outputName = 'out-'+movieName
-    clip1 = VideoFileClip(movieName)
-    out_clip = clip1.fl_image(imagePipeline) #NOTE: this function expects color images!!
-    out_clip.write_videofile(outputName, audio=False)
+def processMovieSegments(movieName, workers, outputName=None, segments=None, warmup=30):
+    """Split a movie into 'segments' time ranges (default one per worker) and run each 
+        one start to end in its own process with its own LaneLines, then join the 
+        segment movies.  Each segment decodes 'warmup' extra frames before its range to 
+        settle tracking.  Returns the per-frame lane fits.
+    """
+    import multiprocessing
+    import UtilParallel
+    import UtilVideo
+    outputName = outputName or 'out-'+movieName
+    workers = workers or os.cpu_count()
+    segments = segments or workers
+    size, fps, frameCount = UtilVideo.probeMovie(movieName)
+    warmUp(size)
+    # no empty segments
+    segments = max(1, min(segments, frameCount))
+    bounds = [int(b) for b in np.linspace(0, frameCount, segments + 1)]
+    settings = pipelineSettings()
+    tasks = []
+    for seg in range(segments):
+        # the frame count is only an estimate for some containers, the last one runs to the end
+        stop = bounds[seg+1] if seg < segments-1 else None
+        tasks.append((movieName, '{}.seg{:03d}.mp4'.format(outputName, seg), bounds[seg], stop, warmup, settings, 
+                      stats.enabled, stats.trace is not None))
+    
+    with multiprocessing.Pool(min(workers, segments)) as pool:
+        results = pool.map(UtilParallel.segmentWorker, tasks, chunksize=1)
+    fits = [segFits for segFits, segStats in results]
+    for segFits, segStats in results:
+        if segStats:
+            stats.merge(segStats)
+    segNames = [task[1] for task in tasks]
+    UtilVideo.concatMovies(segNames, outputName, fps)
+    expected = sum(len(segFits) for segFits in fits)
+    written  = UtilVideo.probeMovie(outputName)[2] if os.path.isfile(outputName) else 0
+    if written != expected:
+        raise Exception("Error, %s has %d of %d frames, segment files are kept" %(outputName, written, expected))
+    for segName in segNames:
+        os.remove(segName)
+    return np.concatenate(fits)
 
-import sys
+IMAGE_TYPES = ('.jpg', '.jpeg', '.png')
+# folders of pipeline output, never taken as input
+OUTPUT_DIRS = ('outputs',)
+
+def collectImages(patterns, exclude=()):
+    """Expand folders (searched recursively) and glob patterns (** allowed) to image files.
+        Anything inside an 'outputs' folder or one of the 'exclude' folders is skipped.
+    """
+    excluded = [os.path.abspath(dirName) for dirName in exclude if dirName]
+    fileNames = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, '**', '*')
+        for fileName in glob.glob(pattern, recursive=True):
+            if not os.path.isfile(fileName) or os.path.splitext(fileName)[1].lower() not in IMAGE_TYPES:
+                continue
+            fullName = os.path.abspath(fileName)
+            if any(part in OUTPUT_DIRS for part in os.path.dirname(fullName).split(os.sep)):
+                continue
+            if any(os.path.commonpath([fullName, dirName]) == dirName for dirName in excluded):
+                continue
+            fileNames.add(os.path.normpath(fileName))
+    return sorted(fileNames)
+
+def processBatch(patterns, workers=0, outDir=None, manifestName='manifest.json'):
+    """Run many still images on a process pool ('workers' 0 runs them in this process).
+        Each worker loads the calibration once and every image gets fresh LaneLines.  
+        Annotated images go to 'outDir' (mirroring the input folders) if given, and a 
+        manifest with each file's curvature, offset and timing is written to 
+        'manifestName'.
+    """
+    import UtilParallel
+    fileNames = collectImages(patterns, exclude=[outDir])
+    if not fileNames:
+        raise Exception("Error, no images found for %s" %' '.join(patterns))
+    root = os.path.commonpath([os.path.dirname(os.path.abspath(f)) for f in fileNames])
+    tasks = []
+    for fileName in fileNames:
+        outName = None
+        if outDir:
+            outName = os.path.join(outDir, os.path.relpath(os.path.abspath(fileName), root)) + '-annot.jpg'
+        tasks.append((fileName, outName))
+    
+    start = time.perf_counter()
+    entries = []
+    for entry in UtilParallel.batchMap(tasks, workers, pipelineSettings()):
+        entries.append(entry)
+        if len(entries) % 100 == 0:
+            print("Processed {} of {}".format(len(entries), len(tasks)))
+    elapsed = time.perf_counter() - start
+    
+    entries.sort(key=lambda entry: entry['file'])
+    failed = sum(1 for entry in entries if 'error' in entry)
+    manifest = {'images': len(entries), 'failed': failed, 'workers': workers, 
+                'total_s': elapsed, 'images_per_s': len(entries)/elapsed, 'files': entries}
+    with open(manifestName, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    print("Processed {} images ({} failed) in {:.1f} s, manifest in {}".format(len(entries), failed, elapsed, manifestName))
+    return manifest
+
+def processMovie(movieName, workers=0, outputName=None):
+    """Run the pipeline over every frame of a movie.  Decoding and encoding run on their
+        own threads.  With 'workers' > 0 the stateless stages run on a process pool, while
+        lane tracking and the overlay stay in frame order here.  Both modes write 
+        identical output.  In adaptive mode frames expected to coast are only 
+        un-distorted by the pool, and prepared here if the guess was wrong.
+    """
+    import UtilParallel
+    import UtilVideo
+    outputName = outputName or 'out-'+movieName
+    reader = UtilVideo.FrameReader(movieName)
+    warmUp(reader.size)
+    prepared = None
+    done = 0    # frames finished by the consumer
+    raw  = {}   # frames dispatched as coasting, by index, in case they need detection
+    
+    def tasks():
+        for idx, frame in enumerate(reader.frames()):
+            # reader buffers are recycled, so hand the pool its own copy of each frame
+            frame = frame.copy()
+            coast = laneLines.willCoast(idx - done + 1)
+            if coast:
+                raw[idx] = frame
+            yield idx, frame, coast
+    
+    try:
+        with UtilVideo.FrameWriter(outputName, reader.size, reader.fps) as writer:
+            if workers > 0:
+                prepared = UtilParallel.orderedMap(UtilParallel.prepareWorker, tasks(), workers, 
+                                                   initializer=UtilParallel.initWorker, initargs=(pipelineSettings(),))
+                for idx, imgUD, topDown, binary in prepared:
+                    if not laneLines.needsDetection():
+                        writer.write(finishFrame(imgUD, None, None))
+                    elif topDown is None:
+                        # expected to coast, but the lanes need a detection after all
+                        stats.count('coastMissed')
+                        topDown = birdsEye(raw[idx], imgUD)
+                        writer.write(finishFrame(imgUD, topDown, UtilMask.FrameMask(topDown, pool=buffers)))
+                    else:
+                        frameMask = UtilMask.FrameMask(topDown)
+                        frameMask.seed(binary)
+                        writer.write(finishFrame(imgUD, topDown, frameMask))
+                    raw.pop(idx, None)
+                    done = idx + 1
+            else:
+                for frame in reader.frames():
+                    writer.write(imagePipeline(frame))
+    finally:
+        # on an error, stop the pool and the decoder thread instead of leaving them waiting
+        if prepared is not None:
+            prepared.close()
+        reader.close()
+
+import argparse
 if __name__ == '__main__':
     """Main processing script.
         If no arguments given, it will process all images in the test_images folder.  
         A single argument is the name of a movie to process.
     """
-    if len(sys.argv) > 1:
-        processMovie(sys.argv[1])
+    parser = argparse.ArgumentParser(description='Advanced lane finding')
+    parser.add_argument('movie', nargs='?', help='movie to process, default is the test_images folder')
+    parser.add_argument('--workers', type=int, help='process pool size, 0 is serial, default serial for movies and one per CPU for --batch and --segments')
+    parser.add_argument('--segments', type=int, help='split the movie into this many time segments processed in parallel, 0 is one per worker')
+    parser.add_argument('--warmup', type=int, default=30, help='frames decoded before each segment to settle tracking')
+    parser.add_argument('--batch', nargs='+', metavar='PATH', help='folders or glob patterns of stills to process in parallel')
+    parser.add_argument('--out-dir', help='folder for annotated --batch images')
+    parser.add_argument('--manifest', default='manifest.json', help='--batch summary file')
+    parser.add_argument('--debug-format', default='jpg', choices=['jpg', 'frame', 'run'], 
+                        help='test image debug output: JPEG per stage, or one .npz per frame or per run')
+    parser.add_argument('--coarse', type=float, help='downscale factor for coarse-to-fine blind searches, e.g. 0.5')
+    parser.add_argument('--fused-warp', action='store_true', help='un-distort and warp to the birds-eye view in one remap, slightly different results')
+    parser.add_argument('--adaptive', action='store_true', help='smooth fits and skip detection on stable frames')
+    parser.add_argument('--telemetry', metavar='FILE', help='headless movie mode, only write per-frame lane numbers to FILE')
+    parser.add_argument('--telemetry-format', default='npy', choices=['npy', 'csv'], help='chunked binary columns or CSV')
+    parser.add_argument('--stats', action='store_true', help='print stage timers and tracker counters at the end')
+    parser.add_argument('--trace', help='also write per-frame stats as JSON lines to this file')
+    args = parser.parse_args()
+    
+    debug.format = args.debug_format
+    FUSED_WARP = args.fused_warp
+    if args.coarse:
+        UtilLines.LaneLines.coarseScale = args.coarse
+    if args.adaptive:
+        UtilLines.LaneLines.adaptive = True
+    if args.stats or args.trace:
+        stats.enable(args.trace)
+    
+    if args.batch:
+        processBatch(args.batch, os.cpu_count() if args.workers is None else args.workers, args.out_dir, args.manifest)
+    elif args.movie and args.telemetry:
+        processTelemetry(args.movie, args.telemetry, args.telemetry_format)
+    elif args.movie and args.segments is not None:
+        processMovieSegments(args.movie, args.workers or os.cpu_count(), segments=args.segments, warmup=args.warmup)
+    elif args.movie:
+        processMovie(args.movie, args.workers or 0)
     else:
         processImages()
+    
+    if stats.enabled:
+        stats.report()
+        stats.disable()